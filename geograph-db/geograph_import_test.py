@@ -0,0 +1,385 @@
+from contextlib import ExitStack, redirect_stdout
+import gzip
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import importlib.machinery
+import importlib.util
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+
+# geograph_import is a script without a .py suffix, so it has to be
+# loaded by hand.
+def load_script(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that multiprocessing can pickle its functions.
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+geograph_import = load_script('geograph_import')
+
+headings = {
+    'gridimage_base': "gridimage_id\tuser_id\trealname\ttitle\t"
+        "moderation_status\timagetaken\tgrid_reference\tx\ty\t"
+        "wgs84_lat\twgs84_long\treference_index",
+    'gridimage_extra': "gridimage_id\tftf\tsubmitted\tupd_timestamp\t"
+        "credit_realname\tseq_no\tpoints",
+    'gridimage_geo': "gridimage_id\tnateastings\tnatnorthings\tnatgrlen\t"
+        "viewpoint_eastings\tviewpoint_northings\tviewpoint_grlen\t"
+        "view_direction\tuse6fig",
+    'gridimage_size': "gridimage_id\twidth\theight\toriginal_width\t"
+        "original_height\toriginal_diff",
+}
+
+def base_line(gridimage_id, title):
+    return ("%d\t12\tA. N. Other\t%s\tgeograph\t2010-04-11\tSO8001\t380\t"
+            "201\t51.71\t-2.27\t1" % (gridimage_id, title))
+
+def extra_line(gridimage_id, upd_timestamp):
+    return ("%d\t1\t2010-04-12 10:00:00\t%s\t0\t1\t" %
+            (gridimage_id, upd_timestamp))
+
+def geo_line(gridimage_id):
+    return "%d\t380930\t201360\t8\t380980\t201340\t8\t292\t1" % gridimage_id
+
+def size_line(gridimage_id, original_width):
+    return "%d\t640\t480\t%d\t%d\t" % (gridimage_id, original_width,
+                                       original_width * 3 // 4)
+
+class ImportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        self.mtime = 1600000000
+    def tearDown(self):
+        os.chdir(self.olddir)
+        self.tmpdir.cleanup()
+    def write_dumps(self, ids, titles={}, updated={}, originals={},
+                    mtime=None):
+        # Each set of dumps is newer than the last unless told otherwise.
+        if mtime == None:
+            self.mtime += 100
+            mtime = self.mtime
+        lines = {
+            'gridimage_base': [base_line(i, titles.get(i, "Title %d" % i))
+                               for i in ids],
+            'gridimage_extra': [extra_line(i, updated.get(
+                i, "2010-04-12 10:00:00")) for i in ids],
+            'gridimage_geo': [geo_line(i) for i in ids],
+            'gridimage_size': [size_line(i, originals.get(i, 0))
+                               for i in ids],
+        }
+        for tablename, heading in headings.items():
+            with gzip.open(tablename + ".tsv.gz", mode='wt',
+                           encoding='cp1252', newline='\n') as f:
+                for line in [heading] + lines[tablename]:
+                    f.write(line + "\n")
+            self.set_mtime(tablename, mtime)
+    def set_mtime(self, tablename, mtime):
+        os.utime(tablename + ".tsv.gz", (mtime, mtime))
+    def import_dumps(self, incremental=False, bulk=False, baseurl=None,
+                     report=None):
+        # As main() does it.
+        db = sqlite3.connect("geograph.sqlite3")
+        with db:
+            geograph_import.create_tables(db)
+        try:
+            with ExitStack() as stack:
+                if bulk:
+                    loaded = stack.enter_context(
+                        geograph_import.bulk_parsed_tables(
+                            db, incremental, baseurl=baseurl, report=report))
+                with db:
+                    if bulk:
+                        geograph_import.bulk_import_tables(
+                            db, loaded, incremental, report=report)
+                    else:
+                        for tablename in geograph_import.schema:
+                            geograph_import.import_table(
+                                db, tablename, incremental=incremental,
+                                baseurl=baseurl, report=report)
+                    geograph_import.build_gridimage(db, incremental)
+        finally:
+            db.close()
+        return sqlite3.connect("geograph.sqlite3")
+
+class IncrementalTests(ImportTestCase):
+    def test_full(self):
+        self.write_dumps([1, 2, 3], titles={2: "Tab\tin title"})
+        db = self.import_dumps()
+        self.assertEqual(
+            db.execute("SELECT gridimage_id, title FROM gridimage_base")
+              .fetchall(),
+            [(1, "Title 1"), (2, "Tab\tin title"), (3, "Title 3")])
+        self.assertEqual(
+            db.execute("SELECT * FROM changes WHERE tablename = ?",
+                       ('gridimage_geo',)).fetchone()[2:], (3, 0, 0))
+    def test_incremental(self):
+        self.write_dumps([1, 2, 3, 4])
+        self.import_dumps()
+        self.write_dumps([1, 2, 4, 5], titles={2: "New title"},
+                         updated={4: "2020-01-01 00:00:00"})
+        db = self.import_dumps(incremental=True)
+        self.assertEqual(
+            db.execute("SELECT gridimage_id, title FROM gridimage_base")
+              .fetchall(),
+            [(1, "Title 1"), (2, "New title"), (4, "Title 4"),
+             (5, "Title 5")])
+        changes = { r[0]: r[2:] for r in db.execute(
+            "SELECT * FROM changes WHERE rowid > 4") }
+        self.assertEqual(changes, {
+            'gridimage_base': (1, 1, 1),
+            'gridimage_extra': (1, 1, 1),
+            'gridimage_geo': (1, 0, 1),
+            'gridimage_size': (1, 0, 1),
+        })
+    def test_incremental_unchanged(self):
+        self.write_dumps([1, 2, 3])
+        self.import_dumps()
+        self.write_dumps([1, 2, 3])
+        db = self.import_dumps(incremental=True)
+        self.assertEqual(
+            db.execute("SELECT SUM(inserted + updated + deleted) FROM changes"
+                       " WHERE rowid > 4").fetchone(), (0,))
+        self.assertEqual(
+            db.execute("SELECT COUNT(*) FROM gridimage_size").fetchone(),
+            (3,))
+    def test_incremental_not_modified(self):
+        self.write_dumps([1, 2, 3])
+        self.import_dumps()
+        db = self.import_dumps(incremental=True)
+        self.assertEqual(
+            db.execute("SELECT COUNT(*) FROM changes").fetchone(), (4,))
+
+class GridimageTests(ImportTestCase):
+    def test_columns(self):
+        self.write_dumps([1, 2])
+        db = self.import_dumps()
+        db.row_factory = sqlite3.Row
+        row = db.execute("SELECT * FROM gridimage WHERE gridimage_id = 2"
+                         ).fetchone()
+        self.assertEqual(row['title'], "Title 2")
+        self.assertEqual(row['view_direction'], 292)
+        self.assertEqual(row['upd_timestamp'], "2010-04-12 10:00:00")
+        self.assertEqual(row['original_width'], 0)
+    def test_incremental(self):
+        self.write_dumps([1, 2, 3, 4])
+        self.import_dumps()
+        self.write_dumps([1, 2, 4, 5], titles={2: "New title"},
+                         originals={4: 1024})
+        db = self.import_dumps(incremental=True)
+        self.assertEqual(
+            db.execute("SELECT gridimage_id, title, original_width "
+                       "FROM gridimage").fetchall(),
+            [(1, "Title 1", 0), (2, "New title", 0), (4, "Title 4", 1024),
+             (5, "Title 5", 0)])
+    def test_missing_size(self):
+        self.write_dumps([1, 2])
+        with gzip.open("gridimage_size.tsv.gz", mode='wt') as f:
+            f.write(headings['gridimage_size'] + "\n" + size_line(1, 0) +
+                    "\n")
+        db = self.import_dumps()
+        self.assertEqual(
+            db.execute("SELECT gridimage_id, width FROM gridimage").fetchall(),
+            [(1, 640), (2, None)])
+
+class ParserTests(unittest.TestCase):
+    lines = [
+        headings['gridimage_base'],
+        base_line(1, "Plain"),
+        base_line(2, "Tab\tin\ttitle"),
+        base_line(3, "It\\'s &#8470; 5 & \\\\ \u2019curly\u2019"),
+        base_line(4, "[[Brackets]] | = ''"),
+        base_line(5, "Caf\xe9"),
+    ]
+    def parse_both(self, data, chunksize):
+        legacy = list(geograph_import.read_tsv(
+            io.BytesIO(data), geograph_import.parse_line_base))
+        fast = list(geograph_import.read_gridimage_base(
+            io.BytesIO(data), chunksize=chunksize))
+        return legacy, fast
+    def test_fast_base(self):
+        data = gzip.compress(("\n".join(self.lines) + "\n").encode('cp1252'))
+        for chunksize in (1, 7, 100, 1 << 20):
+            legacy, fast = self.parse_both(data, chunksize)
+            self.assertEqual(len(fast), 5)
+            self.assertEqual(fast, legacy)
+        self.assertEqual(fast[1][3], "Tab\tin\ttitle")
+    def test_no_final_newline(self):
+        data = gzip.compress("\n".join(self.lines).encode('cp1252'))
+        legacy, fast = self.parse_both(data, 10)
+        self.assertEqual(fast, legacy)
+
+class BulkTests(ImportTestCase):
+    def test_bulk(self):
+        ids = range(1, 1000)
+        self.write_dumps(ids, titles={7: "Tab\tin title"})
+        db = self.import_dumps(bulk=True)
+        for tablename in geograph_import.schema:
+            self.assertEqual(
+                db.execute("SELECT COUNT(*) FROM " + tablename).fetchone(),
+                (len(ids),))
+        self.assertEqual(
+            db.execute("SELECT title FROM gridimage_base "
+                       "WHERE gridimage_id = 7").fetchone(), ("Tab\tin title",))
+    def test_bulk_incremental(self):
+        self.write_dumps([1, 2, 3])
+        self.import_dumps(bulk=True)
+        self.write_dumps([1, 3], originals={3: 1024})
+        db = self.import_dumps(incremental=True, bulk=True)
+        self.assertEqual(
+            db.execute("SELECT * FROM changes WHERE rowid > 4 "
+                       "AND tablename = 'gridimage_size'").fetchone()[2:],
+            (0, 1, 1))
+
+class ReportTests(ImportTestCase):
+    def add_line(self, tablename, line):
+        with gzip.open(tablename + ".tsv.gz", mode='at',
+                       encoding='cp1252', newline='\n') as f:
+            f.write(line + "\n")
+        self.set_mtime(tablename, self.mtime)
+    def check_parse_errors(self, bulk):
+        self.write_dumps([1, 2, 3])
+        self.add_line('gridimage_geo', "4\t380930\t201360")
+        self.add_line('gridimage_size', "garbage")
+        report = geograph_import.ImportReport()
+        db = self.import_dumps(bulk=bulk, report=report)
+        self.assertEqual(report.tables['gridimage_geo']['rows'], 3)
+        self.assertEqual(report.tables['gridimage_geo']['parse_errors'], 1)
+        self.assertEqual(report.tables['gridimage_size']['parse_errors'], 1)
+        self.assertEqual(report.tables['gridimage_base']['parse_errors'], 0)
+        # The good lines still went in.
+        self.assertEqual(db.execute("SELECT COUNT(*) FROM gridimage_geo")
+                           .fetchone()[0], 3)
+    def test_parse_errors(self):
+        self.check_parse_errors(bulk=False)
+    def test_parse_errors_bulk(self):
+        self.check_parse_errors(bulk=True)
+    def test_change(self):
+        self.write_dumps([1, 2, 3])
+        db = self.import_dumps()
+        self.write_dumps([1, 2, 3, 4])
+        report = geograph_import.ImportReport(
+            geograph_import.count_rows(db), max_shrink=10)
+        self.import_dumps(incremental=True, report=report)
+        self.assertEqual(report.tables['gridimage_base']['previous_rows'], 3)
+        self.assertEqual(report.tables['gridimage_base']['change'], 1)
+    def test_shrink(self):
+        self.write_dumps(range(1, 11))
+        db = self.import_dumps()
+        self.write_dumps([1, 2, 3])
+        report = geograph_import.ImportReport(
+            geograph_import.count_rows(db), max_shrink=10)
+        with self.assertRaises(geograph_import.ImportAborted):
+            self.import_dumps(incremental=True, report=report)
+        # Nothing should have been changed.
+        self.assertEqual(
+            db.execute("SELECT COUNT(*) FROM gridimage_base").fetchone(),
+            (10,))
+    def run_main(self, *args):
+        oldargv = sys.argv
+        sys.argv = ["geograph_import"] + list(args)
+        try:
+            with redirect_stdout(io.StringIO()):
+                geograph_import.main()
+        finally:
+            sys.argv = oldargv
+    def test_abort_after_bulk_tables(self):
+        # An import that fails the gridimage check leaves the base
+        # tables as they were, so that the next run tries again rather
+        # than finding the dumps not modified.
+        self.write_dumps(range(1, 11))
+        self.run_main()
+        with sqlite3.connect("geograph.sqlite3") as db:
+            last_modified = geograph_import.stored_last_modified(
+                db, 'gridimage_base')
+        self.write_dumps(range(1, 12))
+        count_rows = geograph_import.count_rows
+        def inflated(db):
+            counts = count_rows(db)
+            counts['gridimage'] *= 2
+            return counts
+        geograph_import.count_rows = inflated
+        try:
+            with self.assertRaises(SystemExit):
+                self.run_main("--incremental", "--bulk")
+        finally:
+            geograph_import.count_rows = count_rows
+        db = sqlite3.connect("geograph.sqlite3")
+        self.assertEqual(
+            db.execute("SELECT COUNT(*) FROM gridimage_base").fetchone(),
+            (10,))
+        self.assertEqual(
+            geograph_import.stored_last_modified(db, 'gridimage_base'),
+            last_modified)
+        db.close()
+
+class FetchTests(ImportTestCase):
+    # A local stand-in for data.geograph.org.uk, serving dumps from
+    # their own directory.  SimpleHTTPRequestHandler sends
+    # Last-Modified and honours If-Modified-Since.
+    def setUp(self):
+        super().setUp()
+        os.mkdir("dumps")
+        handler = partial(QuietHandler, directory="dumps")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.baseurl = "http://127.0.0.1:%d/" % (self.server.server_port,)
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+    def write_served_dumps(self, *args, **kwargs):
+        os.chdir("dumps")
+        try:
+            self.write_dumps(*args, mtime=1600000000, **kwargs)
+        finally:
+            os.chdir("..")
+    def changes(self, db):
+        return { r[0]: r[1:] for r in db.execute(
+            "SELECT tablename, last_modified, inserted, updated, deleted "
+            "FROM changes WHERE rowid > 4") }
+    def check_conditional(self, bulk):
+        self.write_served_dumps([1, 2, 3])
+        db = self.import_dumps(bulk=bulk, baseurl=self.baseurl)
+        self.assertEqual(
+            db.execute("SELECT * FROM sources WHERE tablename = ?",
+                       ('gridimage_size',)).fetchone(),
+            ('gridimage_size', "2020-09-13 12:26:40Z"))
+        self.assertEqual(
+            db.execute("SELECT COUNT(*) FROM gridimage_base").fetchone(),
+            (3,))
+        # Nothing has changed, so nothing should be imported.
+        db = self.import_dumps(incremental=True, bulk=bulk,
+                               baseurl=self.baseurl)
+        self.assertEqual(self.changes(db), {})
+        # Now change just one table.
+        self.write_served_dumps([1, 2, 3], originals={2: 1024})
+        os.chdir("dumps")
+        self.set_mtime('gridimage_size', 1700000000)
+        os.chdir("..")
+        db = self.import_dumps(incremental=True, bulk=bulk,
+                               baseurl=self.baseurl)
+        self.assertEqual(self.changes(db), {
+            'gridimage_size': ("2023-11-14 22:13:20Z", 0, 1, 0) })
+    def test_conditional(self):
+        self.check_conditional(bulk=False)
+    def test_conditional_bulk(self):
+        self.check_conditional(bulk=True)
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+if __name__ == '__main__':
+    unittest.main()
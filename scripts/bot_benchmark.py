@@ -0,0 +1,233 @@
+#! /usr/bin/python3
+
+# Push thousands of synthetic pages through update_metadata or
+# upgrade_size, with Commons, Geograph and MapIt replaced by the
+# stand-in in replay.py, and report how quickly they went through.
+# Nothing touches the network, so runs are comparable from one change
+# to the next.  Anything after the bot's name is passed to it, for
+# example:
+#
+#   python3 scripts/bot_benchmark.py update_metadata -prefetch:8
+#   python3 scripts/bot_benchmark.py --pages 500 upgrade_size
+#
+# pywikibot's own chatter goes to stderr; the report goes to stdout.
+
+import argparse
+import importlib
+import importlib.machinery
+import importlib.util
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import mwparserfromhell
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+bots = {
+    'update_metadata': 'UpdateMetadataBot',
+    'upgrade_size': 'UpgradeSizeBot',
+}
+
+user_config = """
+family = 'commons'
+mylang = 'commons'
+usernames['commons']['commons'] = %r
+put_throttle = 0
+minthrottle = 0
+maxthrottle = 0
+max_retries = 0
+"""
+
+def load_importer():
+    # geograph_import is a script without a .py suffix.
+    name = 'geograph_import'
+    path = os.path.join(scriptdir, "..", "geograph-db", name)
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+def synthetic_rows(n, rng):
+    # Rows for gridimage_base, gridimage_extra, gridimage_geo and
+    # gridimage_size, in that order, for Geograph IDs 1 to n.  All are
+    # in Great Britain, with 8-figure camera and subject locations.
+    for i in range(1, n + 1):
+        east = rng.randrange(300000, 400000)
+        north = rng.randrange(200000, 300000)
+        grid_reference = "SO%02d%02d" % (east // 1000 % 100,
+                                         north // 1000 % 100)
+        realname = "Photographer %d" % (rng.randrange(1000),)
+        if rng.random() < 0.6:
+            original = (1600, 1200, "no")
+        else:
+            original = (0, 0, "")
+        yield ((i, rng.randrange(1000), realname,
+                "View of square %d" % (i,), "geograph", "2010-04-11",
+                grid_reference, 0, 0, 52.0, -2.0, 1),
+               (i, 0, "2010-04-12 10:00:00", "2020-01-01 00:00:00", 0, 1, ""),
+               (i, east, north, "8", east + rng.randrange(-200, 200),
+                north + rng.randrange(-200, 200), "8", rng.randrange(360), 1),
+               (i, 640, 480) + original)
+
+def build_geograph_db(path, n, rng):
+    geograph_import = load_importer()
+    db = sqlite3.connect(path)
+    geograph_import.create_tables(db)
+    rows = list(synthetic_rows(n, rng))
+    for i, table in enumerate(('gridimage_base', 'gridimage_extra',
+                               'gridimage_geo', 'gridimage_size')):
+        db.executemany("INSERT INTO %s VALUES (%s)" %
+                       (table, ", ".join("?" * len(rows[0][i]))),
+                       [r[i] for r in rows])
+    db.execute("INSERT INTO sources VALUES ('gridimage_geo', ?)",
+               ("2024-01-01 00:00:00Z",))
+    geograph_import.build_gridimage(db)
+    geograph_import.create_indexes(db)
+    db.commit()
+    db.close()
+
+def page_text(row, kind):
+    # The description page of the Commons copy of a Geograph image.
+    # kind says how it differs from what update_metadata would make of
+    # it: 'bare' has no location, 'stale' has one from an older
+    # version of the Geograph row, and 'current' is up to date apart
+    # from the credit line.
+    from location import (location_from_row, object_location_from_row,
+                          set_location, set_object_location)
+    tree = mwparserfromhell.parse(
+        "=={{int:filedesc}}==\n"
+        "{{Information\n|description={{en|1=%s}}\n|date=2010-04-11\n"
+        "|source=From [https://www.geograph.org.uk/photo/%d geograph.org.uk]"
+        "\n|author=%s\n|permission=\n|other versions=\n}}\n\n"
+        "=={{int:license-header}}==\n{{Geograph|%d|%s}}\n" %
+        (row['title'], row['gridimage_id'], row['realname'],
+         row['gridimage_id'], row['realname']))
+    if kind == 'stale':
+        row = dict(row, viewpoint_eastings=row['viewpoint_eastings'] + 500,
+                   nateastings=row['nateastings'] + 500)
+    if kind != 'bare':
+        set_location(tree, location_from_row(row))
+        set_object_location(tree, object_location_from_row(row))
+    return str(tree)
+
+def synthetic_pages(db, n, rng):
+    import replay
+    pages = [ ]
+    db.row_factory = sqlite3.Row
+    rows = db.execute("SELECT * FROM gridimage ORDER BY gridimage_id")
+    for row in rows.fetchmany(n):
+        gridimage_id = row['gridimage_id']
+        kind = rng.choice(('bare', 'stale', 'current'))
+        page = replay.FilePage(
+            10000000 + gridimage_id,
+            "File:%s (geograph %d).jpg" % (row['title'], gridimage_id),
+            page_text(row, kind))
+        # The 640px version, so that upgrade_size finds it matches.
+        page.add_file(replay.geograph_jpeg(gridimage_id, 'basic'),
+                      row['width'], row['height'], "Geograph Import Bot")
+        pages.append(page)
+    return pages
+
+class PhaseTimes(object):
+    # Time spent inside the bot's treat_page(); the rest of a run is
+    # spent in the generators (loading and preloading pages).
+    def __init__(self, botclass):
+        self.treating = 0.0
+        self.pages = 0
+        original = botclass.treat_page
+        timer = self
+        def treat_page(self):
+            starttime = time.perf_counter()
+            try:
+                original(self)
+            finally:
+                timer.treating += time.perf_counter() - starttime
+                timer.pages += 1
+        botclass.treat_page = treat_page
+
+def main():
+    parser = argparse.ArgumentParser(description=
+        "Time a bot on synthetic pages with a stand-in Commons and "
+        "Geograph.")
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--precompute', action='store_true',
+                        help="run precompute_locations first")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the results to FILE")
+    parser.add_argument('bot', choices=sorted(bots))
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    rng = random.Random(args.seed)
+    results = dict(bot=args.bot, pages=args.pages, args=args.args)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        starttime = time.perf_counter()
+        # Everything the bots read or write goes in tmpdir.
+        import replay
+        with open(os.path.join(tmpdir, "user-config.py"), 'w') as f:
+            f.write(user_config % (replay.username,))
+        os.environ['PYWIKIBOT_DIR'] = tmpdir
+        for var, name in (('geograph_db', "geograph.sqlite3"),
+                          ('geograph_sizes', "geograph.sizes"),
+                          ('gub_state', "gub-state.sqlite3"),
+                          ('gub_category_index', "category.sqlite3")):
+            os.environ[var] = os.path.join(tmpdir, name)
+        olddir = os.getcwd()
+        os.chdir(tmpdir)
+        build_geograph_db(os.environ['geograph_db'], args.pages, rng)
+        if args.precompute:
+            import precompute_locations
+            precompute_locations.main()
+        db = sqlite3.connect(os.environ['geograph_db'])
+        pages = synthetic_pages(db, args.pages, rng)
+        db.close()
+        with open("titles.txt", 'w') as f:
+            for page in pages:
+                print(page.title, file=f)
+        standin = replay.StandIn(pages, geograph_db=os.environ['geograph_db'])
+        uninstall = replay.install(standin)
+        results['setup'] = time.perf_counter() - starttime
+        try:
+            module = importlib.import_module(args.bot)
+            phases = PhaseTimes(getattr(module, bots[args.bot]))
+            starttime = time.perf_counter()
+            module.main("-file:titles.txt", *args.args)
+            results['run'] = time.perf_counter() - starttime
+        finally:
+            uninstall()
+            os.chdir(olddir)
+    results.update(
+        treated=phases.pages, treating=phases.treating,
+        generating=results['run'] - phases.treating,
+        edits=standin.edits, uploads=standin.uploads,
+        requests={kind: dict(count=standin.counts[kind],
+                             time=standin.times[kind])
+                  for kind in standin.counts},
+        unhandled=dict(standin.unhandled),
+        phases=importlib.import_module('phases').summary())
+    print("%s: %d pages in %.1f s, %.1f pages/s (setup %.1f s)" %
+          (args.bot, phases.pages, results['run'],
+           phases.pages / results['run'], results['setup']))
+    print("  treat_page %.1f s, generators %.1f s" %
+          (results['treating'], results['generating']))
+    print("  %d edits, %d uploads" % (standin.edits, standin.uploads))
+    for kind, r in sorted(results['requests'].items()):
+        print("  %-24s %6d requests, %.2f s answering" %
+              (kind, r['count'], r['time']))
+    for kind, count in sorted(standin.unhandled.items()):
+        print("  not modelled: %s (%d)" % (kind, count))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
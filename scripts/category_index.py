@@ -0,0 +1,161 @@
+from __future__ import print_function
+
+# Build or refresh the local index of the Geograph category on Commons
+# (see gubutil.open_category_index).  The first run lists the whole
+# category.  Later runs only look at what has been added to the
+# category, uploaded over, deleted or moved since the previous run.
+# Files that just drop out of the category aren't noticed that way, so
+# the whole category is listed again every rebuild_interval (or with
+# -rebuild).  Until then, the index can still list them: the bots
+# check each page's own templates before doing anything to it.
+#
+# Each run is a single transaction, so a run that fails part way
+# leaves the index as the previous run left it.
+
+from datetime import datetime, timedelta, timezone
+import pywikibot
+import pywikibot.data.api as api
+import sqlite3
+import time
+
+from gubutil import (category_index_path, geograph_category,
+                     mw_timestamp_format)
+
+def create_tables(db):
+    db.execute("""
+      CREATE TABLE IF NOT EXISTS pages (
+        pageid INTEGER PRIMARY KEY,
+        gridimage_id INTEGER,
+        title TEXT,
+        width INTEGER,
+        height INTEGER,
+        sha1 TEXT,
+        added TEXT
+      )""")
+    db.execute("""
+      CREATE INDEX IF NOT EXISTS pages_gridimage_id
+        ON pages (gridimage_id)""")
+    db.execute("""
+      CREATE INDEX IF NOT EXISTS pages_title ON pages (title)""")
+    db.execute("""
+      CREATE TABLE IF NOT EXISTS state (
+        name TEXT PRIMARY KEY,
+        value TEXT
+      )""")
+
+# Parameters asking for what we store about each file.
+index_props = dict(
+    prop="categories|imageinfo", cllimit="max", clprop="sortkey|timestamp",
+    clcategories=geograph_category, iiprop="size|sha1")
+
+def index_row(item):
+    # Row for the pages table from an API result, or None if it isn't
+    # (any longer) a file in the Geograph category.
+    try:
+        category = item['categories'][0]
+        gridimage_id = int(category['sortkeyprefix'])
+        ii = item['imageinfo'][0]
+        return (item['pageid'], gridimage_id, item['title'],
+                ii['width'], ii['height'], ii['sha1'], category['timestamp'])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+def store(db, items):
+    n = 0
+    for item in items:
+        row = index_row(item)
+        if row == None:
+            if 'pageid' in item:
+                db.execute("DELETE FROM pages WHERE pageid = ?",
+                           (item['pageid'],))
+            db.execute("DELETE FROM pages WHERE title = ?", (item['title'],))
+            continue
+        db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   row)
+        n += 1
+        if n % 10000 == 0:
+            print(n, end="\r")
+    return n
+
+def rebuild(db, site):
+    db.execute("DELETE FROM pages")
+    return store(db, api.QueryGenerator(site=site, parameters=dict(
+        generator="categorymembers", gcmtitle=geograph_category,
+        gcmtype="file", **index_props)))
+
+def refresh(db, site, since):
+    # Files whose pages need fetching again, and ones that have gone.
+    refetch = set()
+    gone = set()
+    for logtype in ("upload", "delete", "move"):
+        for event in api.ListGenerator("logevents", site=site,
+                letype=logtype, lestart=since, ledir="newer",
+                leprop="title|type|details"):
+            if event['ns'] != 6: continue
+            if event['action'] in ('overwrite', 'revert', 'restore'):
+                refetch.add(event['title'])
+            elif event['action'] == 'delete':
+                gone.add(event['title'])
+            elif event['action'] in ('move', 'move_redir'):
+                gone.add(event['title'])
+                refetch.add(event['params']['target_title'])
+    for title in gone - refetch:
+        db.execute("DELETE FROM pages WHERE title = ?", (title,))
+    refetch = sorted(refetch)
+    n = 0
+    for i in range(0, len(refetch), 50):
+        n += store(db, api.QueryGenerator(site=site, parameters=dict(
+            titles="|".join(refetch[i:i + 50]), **index_props)))
+    # Files newly added to the category, including new uploads.
+    n += store(db, api.QueryGenerator(site=site, parameters=dict(
+        generator="categorymembers", gcmtitle=geograph_category,
+        gcmtype="file", gcmsort="timestamp",
+        gcmdir="newer", gcmstart=since, **index_props)))
+    return n
+
+# How often to list the whole category again.
+rebuild_interval = timedelta(days=28)
+
+def get_state(db, name):
+    row = db.execute("SELECT value FROM state WHERE name = ?",
+                     (name,)).fetchone()
+    if row == None:
+        return None
+    return datetime.strptime(row[0], mw_timestamp_format).replace(
+        tzinfo=timezone.utc)
+
+def set_state(db, name, value):
+    db.execute("INSERT OR REPLACE INTO state VALUES (?, ?)",
+               (name, value.strftime(mw_timestamp_format)))
+
+def main(*args):
+    local_args = pywikibot.handle_args(args)
+    site = pywikibot.Site()
+    starttime = time.monotonic()
+    db = sqlite3.connect(category_index_path())
+    with db:
+        create_tables(db)
+    refreshed = get_state(db, 'refreshed')
+    rebuilt = get_state(db, 'rebuilt')
+    # Note the time before we start, so nothing that happens while
+    # we're running is missed next time.
+    now = datetime.now(timezone.utc)
+    with db:
+        if (refreshed == None or rebuilt == None or
+            now - rebuilt > rebuild_interval or '-rebuild' in local_args):
+            n = rebuild(db, site)
+            set_state(db, 'rebuilt', now)
+            print("category index: %d files listed in %.0f s" %
+                  (n, time.monotonic() - starttime))
+        else:
+            # Go back a little, in case of replication lag.
+            since = (refreshed - timedelta(hours=1)).strftime(
+                mw_timestamp_format)
+            n = refresh(db, site, since)
+            print("category index: %d files updated since %s in %.0f s" %
+                  (n, since, time.monotonic() - starttime))
+        set_state(db, 'refreshed', now)
+    db.close()
+
+if __name__ == '__main__':
+    main()
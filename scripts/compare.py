@@ -5,15 +5,19 @@ import pywikibot.bot as bot
 import pywikibot.comms.http as http
 import pywikibot.data.api as api
 
+from phases import phase
+
 def url_to_file(url):
-    r = http.fetch(url)
+    with phase('thumbnail download'):
+        r = http.fetch(url)
     r.raise_for_status()
     return BytesIO(r.content)
 
 def compare_by_url(url0, url1, w, h):
     images = [Image.open(url_to_file(url)) for url in (url0, url1)]
-    rmse = ImageStat.Stat(
-        ImageOps.grayscale(ImageChops.difference(*images))).rms[0] / 256
+    with phase('image compare'):
+        rmse = ImageStat.Stat(
+            ImageOps.grayscale(ImageChops.difference(*images))).rms[0] / 256
     bot.log("RMSE between newest 2 versions: %f" % rmse)
     return rmse
 
@@ -25,8 +29,9 @@ def mark_for_attention(site, title, comment):
     bot.log("marking for human review")
     page = pywikibot.Page(site, title)
     page.text += "\n[[Category:Dubious uploads by Geograph Update Bot]]"
-    page.save("Marked last upload for human attention (%s)"
-              % (comment,))
+    with phase('save'):
+        page.save("Marked last upload for human attention (%s)"
+                  % (comment,))
 
 def compare_revisions(site, parameters):
     # Parameters should include titles= or generator=.
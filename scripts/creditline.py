@@ -8,7 +8,8 @@ from mwparserfromhell.wikicode import Wikicode
 
 import re
 
-from gubutil import tlgetall, tlgetone, canonicalise_name, TooManyTemplates
+from gubutil import (tlgetall, tlgetone, tlchanged, canonicalise_name,
+                     TooManyTemplates)
 
 def wikify(x):
     # Convert a string from the Geograph database into Wikicode.
@@ -48,8 +49,10 @@ def add_creditline(t, line):
             otherfields.value.append(Text(" "))
             otherfields.value.append(line)
             otherfields.value.append(Text("\n"))
+            tlchanged(t)
             return
     info.add("other fields", line)
+    tlchanged(t)
 
 def can_add_creditline(t, line):
     if len(tlgetall(t, ['Credit line'])) != 0:
@@ -12,14 +12,13 @@ from dateutil.tz import gettz
 from math import copysign
 import mwparserfromhell
 import re
-import sqlite3
 from creditline import creditline_from_row, can_add_creditline, add_creditline
 from location import (location_from_row, object_location_from_row,
                       az_dist_between_locations, format_row,
                       format_direction, get_location, has_object_location,
                       set_location, set_object_location)
 
-from gubutil import (connect_geograph_db, get_gridimage_id, TooManyTemplates,
+from gubutil import (get_geograph_row, get_gridimage_id, TooManyTemplates,
                      tlgetone)
 
 # Ways that Geograph locations get in:
@@ -28,9 +27,6 @@ from gubutil import (connect_geograph_db, get_gridimage_id, TooManyTemplates,
 # File Upload Bot (Magnus Manske)
 # Geograph2commons
 
-geodb = connect_geograph_db()
-geodb.row_factory = sqlite3.Row
-
 class NotEligible(Exception):
     pass
 class MinorProblem(Exception):
@@ -146,13 +142,7 @@ class FixLocationBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
         revid = page.latest_revision_id
         tree = mwparserfromhell.parse(page.text)
         gridimage_id = get_gridimage_id(tree)
-        c = geodb.cursor()
-        c.execute("""
-            SELECT * FROM gridimage_base NATURAL JOIN gridimage_geo
-                          NATURAL JOIN gridimage_extra
-               WHERE gridimage_id = ?
-            """, (gridimage_id,))
-        row = c.fetchone()
+        row = get_geograph_row(gridimage_id)
         if row == None:
             raise NotInGeographDatabase("Geograph ID %d not in database" %
                                         (gridimage_id,))
@@ -329,4 +319,5 @@ def main(*args):
         pywikibot.bot.suggest_help(missing_generator=True)
         return False
 
-main()
+if __name__ == '__main__':
+    main()
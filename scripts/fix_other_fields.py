@@ -35,4 +35,5 @@ def main(*args):
         pywikibot.bot.suggest_help(missing_generator=True)
         return False
 
-main()
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,85 @@
 
 from functools import partial
 from itertools import filterfalse
+import mmap
+import os
 from os import environ
 import re
+import sqlite3
+import struct
+import threading
+from urllib.parse import quote
+
+from phases import phase
+
+def geograph_db_path():
+    return environ.get("geograph_db", "geograph-db/geograph.sqlite3")
 
-# Open the Geograph database
+# Open the Geograph database.  The bots only read it, and nothing
+# changes it while they're running (the cron jobs import first), so
+# it's opened immutable: SQLite can then skip locking and checking for
+# changes, and reads go through a memory mapping.
 def connect_geograph_db():
-    return sqlite3.connect(environ.get("geograph_db",
-                                       "geograph-db/geograph.sqlite3"))
+    uri = "file:%s?mode=ro&immutable=1" % (
+        quote(os.path.abspath(geograph_db_path())),)
+    db = sqlite3.connect(uri, uri=True)
+    db.execute("PRAGMA mmap_size = 4294967296") # clamped by SQLite
+    db.execute("PRAGMA cache_size = -65536") # 64 MiB
+    db.row_factory = sqlite3.Row
+    return db
+
+# The connection for the current thread, opened the first time it's
+# wanted.  Connections can't be shared between threads, so worker
+# threads each get their own.
+geodb_local = threading.local()
+
+def geograph_db():
+    try:
+        return geodb_local.db
+    except AttributeError:
+        geodb_local.db = connect_geograph_db()
+        return geodb_local.db
+
+# Memory-mapped copy of gridimage_size written by geograph_import.
+# Looking up an image is just indexing into four arrays, and several
+# bot processes share the same pages of the file.
+class SizeSnapshot(object):
+    header = struct.Struct("=8sII")
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, bom, count = self.header.unpack_from(self.mm)
+        if magic != b"GUBSIZE1" or bom != 0x01020304:
+            raise ValueError("%s is not a size snapshot for this machine" %
+                             (path,))
+        if len(self.mm) != self.header.size + 16 * count:
+            raise ValueError("%s is truncated" % (path,))
+        view = memoryview(self.mm)[self.header.size:]
+        self.count = count
+        (self.width, self.height, self.original_width,
+         self.original_height) = (
+             view[i * 4 * count:(i + 1) * 4 * count].cast('I')
+             for i in range(4))
+    def get(self, gridimage_id):
+        # Returns (width, height, original_width, original_height), or
+        # None if the image isn't in gridimage_size.
+        if not 0 <= gridimage_id < self.count:
+            return None
+        if self.width[gridimage_id] == 0:
+            return None
+        return (self.width[gridimage_id], self.height[gridimage_id],
+                self.original_width[gridimage_id],
+                self.original_height[gridimage_id])
+
+def open_size_snapshot():
+    # Returns a SizeSnapshot, or None if there isn't a usable one.
+    path = environ.get("geograph_sizes")
+    if path == None:
+        path = os.path.splitext(geograph_db_path())[0] + ".sizes"
+    try:
+        return SizeSnapshot(path)
+    except (OSError, ValueError, struct.error):
+        return None
 
 # Template searching functions.
 
@@ -26,8 +98,44 @@ def tlmatchfn(names):
 class TooManyTemplates(Exception):
     pass
 
+# Template names match as titlematch() does: ignoring surrounding space
+# and the case of the first letter.
+def normalise_title(name):
+    name = str(name).strip()
+    return name[:1].upper() + name[1:]
+
+# Every template in a tree, found with a single filter_templates() and
+# indexed by normalised name.  It's attached to the tree the first
+# time tlgetall() is used on it, so anything that adds or removes
+# templates must call tlchanged() afterwards.
+class TemplateIndex(object):
+    def __init__(self, tree):
+        self.templates = tree.filter_templates()
+        self.nnodes = len(tree.nodes)
+        self.positions = { }
+        for i, tl in enumerate(self.templates):
+            self.positions.setdefault(normalise_title(tl.name), []).append(i)
+    def get(self, names):
+        # Matching templates in the order they appear in the tree.
+        positions = set()
+        for name in names:
+            positions.update(self.positions.get(normalise_title(name), []))
+        return [self.templates[i] for i in sorted(positions)]
+
+def template_index(tree):
+    index = getattr(tree, 'gub_template_index', None)
+    # Checking the number of top-level nodes catches most changes that
+    # didn't call tlchanged().
+    if index == None or index.nnodes != len(tree.nodes):
+        index = TemplateIndex(tree)
+        tree.gub_template_index = index
+    return index
+
+def tlchanged(tree):
+    tree.gub_template_index = None
+
 def tlgetall(tree, names):
-    return tree.filter_templates(matches = tlmatchfn(names))
+    return template_index(tree).get(names)
 
 def tlgetone(tree, names):
     tls = tlgetall(tree, names)
@@ -78,53 +186,659 @@ def GeographBotUploads(parameters = None, **kwargs):
     parameters['gaisort'] = 'timestamp'
     return api.PageGenerator("allimages", parameters=parameters, **kwargs)
 
-import sqlite3
 from dateutil.tz import gettz
 
-geodb = connect_geograph_db()
-geodb.row_factory = sqlite3.Row
+def get_geograph_row(gridimage_id):
+    # Return everything we know about a Geograph image, from the
+    # denormalised gridimage table, or None if it's not in the
+    # database.  last_modified is when the gridimage_geo dump was
+    # made.  The location columns come from precompute_locations.py
+    # and are NULL if it hasn't got to this image.
+    with phase('geograph db'):
+        c = geograph_db().cursor()
+        c.execute("""
+            SELECT gridimage.*, sources.last_modified,
+                   l.version AS location_version,
+                   l.camera_lat, l.camera_lon, l.camera_prec,
+                   l.camera_source, l.camera_region,
+                   l.object_lat, l.object_lon, l.object_prec,
+                   l.object_source, l.object_region, l.heading
+              FROM gridimage JOIN sources
+                   LEFT JOIN gridimage_location AS l USING (gridimage_id)
+             WHERE gridimage_id = ? AND sources.tablename = 'gridimage_geo'
+            """, (gridimage_id,))
+        return c.fetchone()
+
+# This query must stay driven by the gridimage_extra_upd_timestamp
+# index: gubutil_test checks its query plan.
+modified_geographs_sql = """
+    SELECT gridimage_id, upd_timestamp
+      FROM gridimage_extra
+     WHERE upd_timestamp >= ? AND submitted < ?
+     ORDER BY upd_timestamp
+    """
+
+def geograph_time(t):
+    # Geograph's timestamps are local time in the UK.
+    return t.astimezone(gettz("Europe/London")).strftime("%Y-%m-%d %H:%M:%S")
 
 def ModifiedGeographs(modified_since, submitted_before):
     # Return images modified on Geograph since the specified start time
     # (as a datetime).
-    c = geodb.cursor()
-    geograph_mod = (
-        modified_since.astimezone(gettz("Europe/London"))
-                      .strftime("%Y-%m-%d %H:%M:%S"))
-    geograph_sub = (
-        submitted_before.astimezone(gettz("Europe/London"))
-                        .strftime("%Y-%m-%d %H:%M:%S"))
-    c.execute("""
-        SELECT gridimage_id
-          FROM gridimage_extra
-         WHERE upd_timestamp >= ? AND submitted < ?
-        """, (geograph_mod, geograph_sub))
-    for row in c:
-        yield from PagesByGeographId(row['gridimage_id'])
+    c = geograph_db().cursor()
+    c.execute(modified_geographs_sql, (geograph_time(modified_since),
+                                       geograph_time(submitted_before)))
+    yield from PagesByGeographIds([row['gridimage_id'] for row in c])
+
+def geograph_id_ranges(gridimage_ids, max_gap=250):
+    # Group sorted Geograph IDs into (first, last) ranges.  Listing a
+    # range of the category costs a request per 500 members, so it's
+    # worth covering a gap between IDs rather than starting a new
+    # request unless the gap is large.
+    ranges = [ ]
+    for gridimage_id in gridimage_ids:
+        if ranges and gridimage_id - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = gridimage_id
+        else:
+            ranges.append([gridimage_id, gridimage_id])
+    return [tuple(r) for r in ranges]
+
+def geograph_file_page(site, title, pageid, gridimage_id):
+    # A file from the Geograph category.  Knowing its page ID lets
+    # DeduplicatedPages and SDCPreloadingGenerator deal with it without
+    # asking Commons.
+    page = pywikibot.FilePage(site, title)
+    page._pageid = pageid
+    page.gridimage_id = gridimage_id
+    return page
+
+def PagesByGeographIds(gridimage_ids, site=None):
+    # Returns all pages with any of the given Geograph IDs, listing
+    # each range of nearby IDs in the category in one go rather than
+    # making a request per ID.
+    if site == None: site = pywikibot.Site()
+    wanted = set(gridimage_ids)
+    index = open_category_index()
+    if index != None:
+        for gridimage_id in sorted(wanted):
+            for pageid, title in index.execute(
+                    "SELECT pageid, title FROM pages WHERE gridimage_id = ?",
+                    (gridimage_id,)):
+                yield geograph_file_page(site, title, pageid, gridimage_id)
+        return
+    for first, last in geograph_id_ranges(sorted(wanted)):
+        for item in api.ListGenerator("categorymembers", site=site,
+                cmtitle="Category:Images from Geograph Britain and Ireland",
+                cmtype="file", cmprop="ids|title|sortkeyprefix",
+                cmstartsortkeyprefix=" %08d" % (first,),
+                cmendsortkeyprefix=" %08d" % (last + 1,)):
+            try:
+                gridimage_id = int(item['sortkeyprefix'])
+            except ValueError:
+                continue # Unparseable sort key.
+            if gridimage_id in wanted:
+                yield geograph_file_page(site, item['title'], item['pageid'],
+                                         gridimage_id)
 
 def PagesByGeographId(gridimage_id):
     # Returns all pages with a given Geograph ID.
-    return api.PageGenerator("categorymembers", parameters=dict(
-        gcmtitle="Category:Images from Geograph Britain and Ireland",
-        gcmtype="file",
-        gcmstartsortkeyprefix=" %08d" % (gridimage_id,),
-        gcmendsortkeyprefix=" %08d" % (gridimage_id + 1,)))
+    return PagesByGeographIds([gridimage_id])
 
 import pywikibot.pagegenerators
-from pywikibot.pagegenerators import PreloadingGenerator
 from datetime import datetime, timedelta, timezone
 from dateutil.tz import gettz
-from itertools import chain
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from itertools import chain, islice
+import queue
+import time
+
+# A local copy of what's in the Geograph category on Commons, kept up
+# to date by category_index.py.  It maps Geograph IDs to page IDs,
+# titles, file sizes and SHA-1 hashes, and saves crawling the category.
+geograph_category = "Category:Images from Geograph Britain and Ireland"
+
+def category_index_path():
+    return environ.get("gub_category_index", "commons-category.sqlite3")
+
+# Timestamps in the index are in MediaWiki's format.
+mw_timestamp_format = "%Y-%m-%dT%H:%M:%SZ"
+
+# An index that hasn't been refreshed for this long is ignored.
+category_index_max_age = timedelta(days=2)
+
+def open_category_index():
+    # Returns a read-only connection to the category index, or None if
+    # there isn't a recent enough one, in which case callers should
+    # ask Commons instead.
+    uri = "file:%s?mode=ro" % (quote(os.path.abspath(category_index_path())),)
+    try:
+        db = sqlite3.connect(uri, uri=True)
+        refreshed, = db.execute(
+            "SELECT value FROM state WHERE name = 'refreshed'").fetchone()
+    except (sqlite3.Error, TypeError):
+        return None
+    refreshed = datetime.strptime(refreshed, mw_timestamp_format).replace(
+        tzinfo=timezone.utc)
+    if datetime.now(timezone.utc) - refreshed > category_index_max_age:
+        db.close()
+        return None
+    return db
+
+def GeographCategoryMembers(site, start=0):
+    # Yield (gridimage_id, title) for every file in the Geograph
+    # category, in order of Geograph ID, starting at start.
+    index = open_category_index()
+    if index != None:
+        yield from index.execute("""
+            SELECT gridimage_id, title FROM pages
+             WHERE gridimage_id >= ? ORDER BY gridimage_id
+            """, (start,))
+        return
+    for item in api.ListGenerator("categorymembers", site=site,
+            cmtitle=geograph_category, cmprop="title|sortkeyprefix",
+            cmtype="file", cmstartsortkeyprefix=" %08d" % (start,)):
+        try:
+            yield int(item['sortkeyprefix']), item['title']
+        except ValueError:
+            continue # Unparseable sort key.
+
+def DeduplicatedPages(gen):
+    # Pass pages through, dropping any that have already been seen.
+    # Pages should already know their page IDs: asking for one that
+    # doesn't would cost an API request, so those are compared by
+    # title instead.
+    seen = set()
+    seen_titles = set()
+    suppressed = 0
+    try:
+        for page in gen:
+            if hasattr(page, '_pageid'):
+                if page._pageid in seen:
+                    suppressed += 1
+                    continue
+                seen.add(page._pageid)
+            else:
+                if page.title() in seen_titles:
+                    suppressed += 1
+                    continue
+                seen_titles.add(page.title())
+            yield page
+    finally:
+        pywikibot.log("%d duplicate pages suppressed" % (suppressed,))
+
+# Look-ahead prefetching.  PrefetchingGenerator calls fetch(page) in a
+# pool of threads for up to window pages ahead of the one the bot is
+# working on.  fetch returns a dict, which is attached to the page as
+# page.prefetched.  The bot then gets things through prefetched(),
+# which falls back to fetching them itself if they aren't there.
+def PrefetchingGenerator(gen, fetch, window=8):
+    def finish(page, future):
+        try:
+            found = future.result()
+            if not hasattr(page, 'prefetched'):
+                page.prefetched = { }
+            page.prefetched.update(found)
+        except Exception as e:
+            # The bot will run into this itself and report it properly.
+            pywikibot.log("prefetching %s failed: %r" % (page, e))
+        return page
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        pending = deque()
+        for page in gen:
+            pending.append((page, executor.submit(fetch, page)))
+            if len(pending) > window:
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+
+def prefetched(page, key, fetch):
+    # Return what was prefetched for page under key, or else fetch().
+    # Each prefetched item is only used once, so anything asked for
+    # again (say, when an edit is restarted) is fetched afresh.
+    try:
+        return page.prefetched.pop(key)
+    except (AttributeError, KeyError):
+        return fetch()
+
+# Structured data.  wbgetentities takes up to 50 IDs at a time, so
+# SDCPreloadingGenerator fetches the statements of pages in batches and
+# leaves them for prefetched(page, 'sdc', ...).
+sdc_batch_size = 50
+
+def load_sdc_statements(pages):
+    # The statements of pages (at most sdc_batch_size of them) in one
+    # request, as a dict keyed by page ID.  A file without any
+    # structured data gets an empty dict.
+    mediaids = { 'M%d' % (page.pageid,): page.pageid for page in pages
+                 if page.pageid > 0 }
+    if not mediaids:
+        return { }
+    request = pages[0].site.simple_request(action='wbgetentities',
+                                           ids=sorted(mediaids),
+                                           props='claims')
+    with phase('sdc fetch'):
+        data = request.submit()
+    return { mediaids[mediaid]: entity.get('statements', { })
+             for mediaid, entity in data['entities'].items()
+             if mediaid in mediaids }
+
+def fetch_sdc_statements(page):
+    return load_sdc_statements([page]).get(page.pageid, { })
+
+def SDCPreloadingGenerator(gen, groupsize=sdc_batch_size):
+    # Pages that don't know their page IDs are passed through as they
+    # are: finding out would cost a request each.
+    gen = iter(gen)
+    while True:
+        batch = list(islice(gen, groupsize))
+        if not batch: break
+        known = [page for page in batch if hasattr(page, '_pageid')]
+        try:
+            statements = load_sdc_statements(known)
+        except Exception as e:
+            # The bot will fetch them itself, and report any problem.
+            pywikibot.log("loading structured data failed: %r" % (e,))
+            statements = { }
+        for page in batch:
+            if getattr(page, '_pageid', None) in statements:
+                if not hasattr(page, 'prefetched'):
+                    page.prefetched = { }
+                page.prefetched['sdc'] = statements[page._pageid]
+            yield page
+
+# The bots' own record of what they've done, so that later runs can
+# skip work.  Unlike the Geograph database and the category index,
+# this is written as the bots go along.
+def state_db_path():
+    return environ.get("gub_state", "gub-state.sqlite3")
+
+# Columns of get_geograph_row() that don't count when deciding whether
+# a row has changed: the date of the dump, which changes every week,
+# and locations that are worked out from the other columns.
+fingerprint_ignored = frozenset((
+    'last_modified', 'location_version',
+    'camera_lat', 'camera_lon', 'camera_prec', 'camera_source',
+    'camera_region', 'object_lat', 'object_lon', 'object_prec',
+    'object_source', 'object_region', 'heading'))
+
+def connect_state_db(path=None):
+    db = sqlite3.connect(path or state_db_path(), timeout=60,
+                         check_same_thread=False)
+    with db:
+        db.execute("""
+          CREATE TABLE IF NOT EXISTS page_state (
+            task TEXT,
+            pageid INTEGER,
+            revid INTEGER,
+            gridimage_id INTEGER,
+            fingerprint TEXT,
+            PRIMARY KEY (task, pageid)
+          )""")
+        db.execute("""
+          CREATE TABLE IF NOT EXISTS checkpoints (
+            task TEXT,
+            name TEXT,
+            value TEXT,
+            PRIMARY KEY (task, name)
+          )""")
+    return db
+
+def row_fingerprint(row, version):
+    # A hash of a Geograph row.  version belongs to the bot using the
+    # fingerprint, and should be changed whenever the bot changes what
+    # it does with a row, so that everything gets looked at again.
+    if row == None:
+        return None
+    data = [version] + [(k, row[k]) for k in sorted(row.keys())
+                        if k not in fingerprint_ignored]
+    return hashlib.sha1(repr(data).encode('utf-8')).hexdigest()
+
+class PageStates(object):
+    # For each page a bot (task) has finished with: the revision it
+    # looked at, the Geograph ID on that revision, and the fingerprint
+    # of the Geograph row it used.
+    def __init__(self, task, path=None):
+        self.task = task
+        self.db = connect_state_db(path)
+        self.lock = threading.Lock()
+    def get(self, pageid):
+        # Returns (revid, gridimage_id, fingerprint) or None.
+        with self.lock:
+            return self.db.execute("""
+                SELECT revid, gridimage_id, fingerprint FROM page_state
+                 WHERE task = ? AND pageid = ?""",
+                (self.task, pageid)).fetchone()
+    def set(self, pageid, revid, gridimage_id, fingerprint):
+        with self.lock, self.db:
+            self.db.execute("""
+                INSERT OR REPLACE INTO page_state VALUES (?, ?, ?, ?, ?)""",
+                (self.task, pageid, revid, gridimage_id, fingerprint))
+
+def SkipUnchangedPages(gen, states, fingerprint, site=None):
+    # Drop pages that haven't been edited since the bot last finished
+    # with them, and whose Geograph row still has the same fingerprint
+    # (fingerprint(gridimage_id) should produce it).  This only asks
+    # for the latest revision IDs, 50 pages at a time, so it should
+    # come before any preloading of page text.
+    if site == None: site = pywikibot.Site()
+    skipped = 0
+    gen = iter(gen)
+    try:
+        while True:
+            batch = list(islice(gen, 50))
+            if not batch: break
+            latest = { }
+            for item in api.QueryGenerator(site=site, parameters=dict(
+                    prop='info', titles='|'.join(p.title() for p in batch))):
+                if 'lastrevid' in item:
+                    latest[item['title']] = (item['pageid'], item['lastrevid'])
+            for page in batch:
+                pageid, revid = latest.get(page.title(), (None, None))
+                state = states.get(pageid) if pageid != None else None
+                if (state != None and state[0] == revid and
+                    state[2] == fingerprint(state[1])):
+                    skipped += 1
+                    continue
+                yield page
+    finally:
+        pywikibot.log("%d unchanged pages skipped" % (skipped,))
+
+# How far each task has got through the stream of new uploads to
+# Commons and of modifications on Geograph.  A mark means everything
+# before it has been dealt with.  Generators label each page with
+# page.checkpoint = (name, value), and CheckpointingGenerator saves
+# the mark as the bot reaches the page.
+class Checkpoints(object):
+    def __init__(self, task, path=None):
+        self.task = task
+        self.db = connect_state_db(path)
+        self.lock = threading.Lock()
+        # Marks to save once every page has been dealt with.
+        self.final = { }
+    def get(self, name):
+        with self.lock:
+            row = self.db.execute("""
+                SELECT value FROM checkpoints WHERE task = ? AND name = ?""",
+                (self.task, name)).fetchone()
+        return None if row == None else row[0]
+    def set(self, name, value):
+        with self.lock, self.db:
+            self.db.execute("""
+                INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)""",
+                (self.task, name, value))
+
+def CheckpointingGenerator(gen, checkpoints, scheduler=None):
+    # This must be the last generator before the bot.  The bot asks
+    # for a page only when it's finished with the previous one, so
+    # yielding a page means everything before it is done, apart from
+    # any writes still with the EditScheduler.  Those are waited for
+    # before the checkpoint is saved.
+    def save(name, value):
+        if scheduler == None:
+            checkpoints.set(name, value)
+        else:
+            scheduler.call_when_done(lambda: checkpoints.set(name, value))
+    for page in gen:
+        if hasattr(page, 'checkpoint'):
+            save(*page.checkpoint)
+        yield page
+    for name, value in checkpoints.final.items():
+        save(name, value)
+
+# Writes.  The bots hand each page's writes (saves, structured data
+# edits and uploads) to an EditScheduler, which makes them from a few
+# worker threads while the bot gets on with the next page.  All the
+# writes for a page go to the same worker, so they happen in the order
+# they were submitted.  The gap between writes starts at the put
+# throttle (-pt).  It doubles whenever pywikibot is told to back off
+# (maxlag or Retry-After), and shrinks a little with each page written
+# without trouble, though never below min_gap (-mingap), so that the
+# servers are never written to flat out.
+class WriteFailed(Exception):
+    # A write submitted to an EditScheduler raised an exception, which
+    # is this one's __cause__.
+    def __init__(self, key, exception):
+        super(WriteFailed, self).__init__(
+            "write for %s failed: %r" % (key, exception))
+        self.key = key
+        self.__cause__ = exception
+
+class EditScheduler(object):
+    def __init__(self, site, workers=4, gap=None, min_gap=1.0,
+                 max_gap=120.0):
+        # With no workers, everything is done straight away, and
+        # pywikibot's put throttle applies as usual.  Otherwise the
+        # put throttle is just where the gap starts.
+        if gap == None:
+            gap = pywikibot.config.put_throttle
+        self.site = site
+        self.gap, self.max_gap = gap, max_gap
+        self.min_gap = min(min_gap, gap)
+        self.lock = threading.Lock()
+        self.next_write = time.monotonic()
+        self.backed_off = None
+        self.backoffs = 0
+        self.submitted = 0
+        self.pending = set()
+        self.waiting = deque()
+        self.failure = None
+        self.reported = False
+        self.queues = [queue.Queue() for i in range(workers)]
+        self.threads = [threading.Thread(target=self.work, args=(q,),
+                                         daemon=True) for q in self.queues]
+        if workers > 0:
+            # pywikibot's own write throttle would hold every write to
+            # the -pt rate, so leave the pacing to us.  Hear about it
+            # when pywikibot has to pause for maxlag, or when any
+            # response (from whichever thread) carries Retry-After.
+            throttle = site.throttle
+            throttle.writedelay = 0
+            lag = throttle.lag
+            def lagged(*args, **kwargs):
+                self.back_off()
+                return lag(*args, **kwargs)
+            throttle.lag = lagged
+            watch_retry_after(throttle, self.back_off)
+        for thread in self.threads:
+            thread.start()
+    def back_off(self, at_least=0):
+        with self.lock:
+            now = time.monotonic()
+            # A maxlag error is heard about twice (lag() and
+            # Retry-After), and several threads can be told at once,
+            # so double the gap only once a second.
+            if self.backed_off == None or now - self.backed_off >= 1:
+                self.gap = max(self.gap * 2, 1.0)
+                self.backoffs += 1
+            self.gap = min(self.max_gap, max(self.gap, at_least))
+            self.backed_off = now
+            self.next_write = now + self.gap
+        pywikibot.log("edit scheduler: backing off, %.1f s between writes" %
+                      (self.gap,))
+    def wait_turn(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_write)
+            self.next_write = start + self.gap
+        time.sleep(start - now)
+    def submit(self, key, write):
+        # Arrange for write() to be called after any writes already
+        # submitted with the same key (a page ID, say).  Once a write
+        # has raised an exception, nothing more is written, and this
+        # raises WriteFailed, naming the key of the write that failed.
+        self.check()
+        if not self.queues:
+            write()
+            return
+        with self.lock:
+            seq = self.submitted
+            self.submitted += 1
+            self.pending.add(seq)
+        self.queues[hash(key) % len(self.queues)].put((seq, key, write))
+    def call_when_done(self, callback):
+        # Call callback() once every write submitted so far has been
+        # made.  Callbacks are called in order, and not at all after a
+        # write has failed.
+        with self.lock:
+            if self.failure == None:
+                self.waiting.append((self.submitted, callback))
+            self.run_callbacks()
+    def run_callbacks(self):
+        # Called with self.lock held.
+        oldest = min(self.pending, default=self.submitted)
+        while self.waiting and self.waiting[0][0] <= oldest:
+            self.waiting.popleft()[1]()
+    def work(self, q):
+        while True:
+            item = q.get()
+            if item == None:
+                break
+            seq, key, write = item
+            failure = None
+            backoffs = None
+            try:
+                # Once something has gone wrong, the bot is stopping,
+                # so don't write anything else.
+                if self.failure == None:
+                    with phase('write wait'):
+                        self.wait_turn()
+                    backoffs = self.backoffs
+                    write()
+            except Exception as e:
+                failure = WriteFailed(key, e)
+            with self.lock:
+                self.pending.discard(seq)
+                if failure != None:
+                    if self.failure == None:
+                        self.failure = failure
+                    self.waiting.clear()
+                elif self.failure == None and self.backoffs == backoffs:
+                    self.gap = max(self.min_gap, self.gap * 0.9)
+                self.run_callbacks()
+    def check(self):
+        with self.lock:
+            failure = self.failure
+            self.reported = self.failure != None
+        if failure != None:
+            raise failure
+    def close(self):
+        # Wait for everything submitted to be written.  A failure is
+        # raised here unless submit() has already raised it.
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.queues = [ ]
+        self.threads = [ ]
+        if not self.reported:
+            self.check()
+
+def watch_retry_after(throttle, back_off):
+    # pywikibot sets throttle.retry_after from every response's
+    # Retry-After header.  Have back_off(seconds) called whenever it's
+    # set to something other than 0.
+    class WatchedThrottle(type(throttle)):
+        @property
+        def retry_after(self):
+            return self.__dict__.get('retry_after', 0)
+        @retry_after.setter
+        def retry_after(self, value):
+            self.__dict__['retry_after'] = value
+            if value:
+                back_off(value)
+    throttle.__class__ = WatchedThrottle
+
+def NewGeographImagesSince(site, since, until):
+    # Like NewGeographImages, but oldest first, and each page knows
+    # when it was added to the category.
+    items = api.ListGenerator("categorymembers", site=site,
+        cmtitle=geograph_category, cmtype="file",
+        cmprop="ids|title|timestamp", cmsort="timestamp",
+        cmdir="newer", cmstart=since, cmend=until)
+    while True:
+        batch = list(islice(items, 50))
+        if not batch: break
+        uploader = { }
+        for item in api.QueryGenerator(site=site, parameters=dict(
+                prop="imageinfo", iiprop="user",
+                pageids="|".join(str(i['pageid']) for i in batch))):
+            if item.get('imageinfo'):
+                uploader[item['pageid']] = item['imageinfo'][0].get('user')
+        for item in batch:
+            # See NewGeographImages.
+            if uploader.get(item['pageid']) == "GeographBot": continue
+            page = pywikibot.FilePage(site, item['title'])
+            page._pageid = item['pageid']
+            page.checkpoint = ('commons', item['timestamp'])
+            yield page
+
+def ModifiedGeographsSince(since, submitted_before, chunk=500):
+    # Like ModifiedGeographs, but in order of modification.  Pages are
+    # found a chunk of images at a time, and come out in no particular
+    # order within a chunk, so each page's checkpoint is the start of
+    # its chunk.
+    rows = geograph_db().execute(modified_geographs_sql,
+                                 (since, submitted_before)).fetchall()
+    for i in range(0, len(rows), chunk):
+        for page in PagesByGeographIds(
+                [row['gridimage_id'] for row in rows[i:i + chunk]]):
+            page.checkpoint = ('geograph', rows[i]['upd_timestamp'])
+            yield page
+
+def PagesSinceLastRun(checkpoints, default_days, site=None):
+    # Everything added to the category or modified on Geograph since
+    # the marks in checkpoints, or for default_days if there aren't
+    # any.  Marks are inclusive, so the pages at a mark get looked at
+    # twice, which SkipUnchangedPages makes cheap.
+    if site == None: site = pywikibot.Site()
+    now = datetime.now(timezone.utc)
+    default = now - timedelta(days=default_days)
+    commons_since = (checkpoints.get('commons') or
+                     default.strftime(mw_timestamp_format))
+    geograph_since = checkpoints.get('geograph') or geograph_time(default)
+    until = now.strftime(mw_timestamp_format)
+    checkpoints.final['commons'] = until
+    yield from NewGeographImagesSince(site, commons_since, until)
+    # Anything submitted since the Commons mark can only be on Commons
+    # if it's been uploaded since then, and we've just covered those.
+    submitted_before = geograph_time(
+        datetime.strptime(commons_since, mw_timestamp_format)
+                .replace(tzinfo=timezone.utc))
+    latest = geograph_db().execute(
+        "SELECT max(upd_timestamp) FROM gridimage_extra").fetchone()[0]
+    checkpoints.final['geograph'] = max(geograph_since, latest or "")
+    yield from ModifiedGeographsSince(geograph_since, submitted_before)
 
 class GeoGeneratorFactory(pywikibot.pagegenerators.GeneratorFactory):
+    def __init__(self, task=None, **kwargs):
+        # task names the bot, for keeping its checkpoints.
+        super(GeoGeneratorFactory, self).__init__(**kwargs)
+        self.task = task
+        self.checkpoints = None
+    def _handle_sincelastrun(self, value):
+        if self.task == None:
+            raise ValueError("-sincelastrun isn't supported here")
+        self.checkpoints = Checkpoints(self.task)
+        return DeduplicatedPages(PagesSinceLastRun(
+            self.checkpoints, int(value or 8), site=pywikibot.Site()))
+    def checkpointed(self, gen, scheduler=None):
+        # Wrap the generator the bot will actually use, so that
+        # -sincelastrun can keep track of how far it's got.
+        if gen == None or self.checkpoints == None:
+            return gen
+        return CheckpointingGenerator(gen, self.checkpoints, scheduler)
     def _handle_recent(self, value):
         starttime = datetime.now(timezone.utc) - timedelta(days=int(value))
         earlystart = starttime - timedelta(days=1)
         extraparams = { 'gcmend': earlystart.astimezone(timezone.utc) }
-        new_on_commons = PreloadingGenerator(
-            NewGeographImages(site=pywikibot.Site(), parameters=extraparams))
+        # No need to preload here: every bot asks the factory for a
+        # preloading generator, which will load these pages anyway.
+        new_on_commons = NewGeographImages(site=pywikibot.Site(),
+                                           parameters=extraparams)
         changed_on_geograph = ModifiedGeographs(
             modified_since = starttime, submitted_before = earlystart)
-        return chain(new_on_commons, changed_on_geograph)
+        return DeduplicatedPages(chain(new_on_commons, changed_on_geograph))
     def _handle_newgeographs(self, value):
         return NewGeographImages(site=pywikibot.Site())
@@ -0,0 +1,398 @@
+from __future__ import division, print_function, unicode_literals
+
+from datetime import datetime, timedelta, timezone
+import importlib.machinery
+import importlib.util
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+
+import mwparserfromhell
+
+import gubutil
+
+def load_importer():
+    # geograph_import is a script without a .py suffix.
+    name = 'geograph_import'
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "..", "geograph-db", name)
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+class QueryPlanTests(unittest.TestCase):
+    def setUp(self):
+        geograph_import = load_importer()
+        self.db = sqlite3.connect(":memory:")
+        geograph_import.create_tables(self.db)
+        geograph_import.build_gridimage(self.db)
+        geograph_import.create_indexes(self.db)
+    def assertIndexed(self, sql, params):
+        plan = [row[3] for row in
+                self.db.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        self.assertTrue(plan)
+        for step in plan:
+            self.assertIn("USING COVERING INDEX", step)
+    def test_modified_geographs(self):
+        self.assertIndexed(gubutil.modified_geographs_sql,
+                           ("2023-05-01 00:00:00", "2023-04-30 00:00:00"))
+
+class TemplateIndexTests(unittest.TestCase):
+    def test_tlgetall(self):
+        tree = mwparserfromhell.parse(
+            "{{ geograph|1|A}}{{Information|other fields={{Credit line}}}}"
+            "{{Also geograph|2|B}}")
+        self.assertEqual(
+            [str(tl.name).strip() for tl in
+             gubutil.tlgetall(tree, ["Also geograph", "Geograph"])],
+            ["geograph", "Also geograph"])
+        self.assertEqual(len(gubutil.tlgetall(tree, ["credit line"])), 1)
+    def test_changed(self):
+        tree = mwparserfromhell.parse("{{Information}}")
+        info = gubutil.tlgetone(tree, ["Information"])
+        self.assertEqual(gubutil.tlgetall(tree, ["Credit line"]), [])
+        info.add("other fields", "{{Credit line}}")
+        gubutil.tlchanged(tree)
+        self.assertEqual(len(gubutil.tlgetall(tree, ["Credit line"])), 1)
+
+class IdRangeTests(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(gubutil.geograph_id_ranges([]), [])
+        self.assertEqual(
+            gubutil.geograph_id_ranges([5, 6, 10, 100, 1000, 1001],
+                                       max_gap=10),
+            [(5, 10), (100, 100), (1000, 1001)])
+
+class CategoryIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "index.sqlite3")
+        self.oldpath = os.environ.get('gub_category_index')
+        os.environ['gub_category_index'] = self.path
+    def tearDown(self):
+        if self.oldpath == None:
+            del os.environ['gub_category_index']
+        else:
+            os.environ['gub_category_index'] = self.oldpath
+        self.tmpdir.cleanup()
+    def make_index(self, refreshed):
+        with sqlite3.connect(self.path) as db:
+            db.execute("CREATE TABLE pages (pageid, gridimage_id, title)")
+            db.execute("INSERT INTO pages VALUES (10, 3, 'File:Three.jpg')")
+            db.execute("CREATE TABLE state (name, value)")
+            db.execute("INSERT INTO state VALUES ('refreshed', ?)",
+                       (refreshed.strftime(gubutil.mw_timestamp_format),))
+        db.close()
+    def test_missing(self):
+        self.assertEqual(gubutil.open_category_index(), None)
+    def test_recent(self):
+        self.make_index(datetime.now(timezone.utc) - timedelta(hours=3))
+        self.assertEqual(list(gubutil.GeographCategoryMembers(None)),
+                         [(3, 'File:Three.jpg')])
+    def test_stale(self):
+        self.make_index(datetime.now(timezone.utc) - timedelta(days=3))
+        self.assertEqual(gubutil.open_category_index(), None)
+
+class FakePage(object):
+    def __init__(self, pageid, title):
+        self._pageid = pageid
+        self._title = title
+    def title(self):
+        return self._title
+
+class DeduplicationTests(unittest.TestCase):
+    def test_sparse_ids(self):
+        # Page IDs can be anywhere, and far apart.
+        ids = [0, 7, 65536, 123456789, 2 ** 40, 7, 2 ** 40, 8]
+        pages = [FakePage(n, "File:%d.jpg" % (n,)) for n in ids]
+        self.assertEqual(
+            [p._pageid for p in gubutil.DeduplicatedPages(iter(pages))],
+            [0, 7, 65536, 123456789, 2 ** 40, 8])
+    def test_deduplicate(self):
+        pages = [FakePage(1, "File:A.jpg"), FakePage(70000, "File:B.jpg"),
+                 FakePage(1, "File:A.jpg"), FakePage(2, "File:C.jpg")]
+        self.assertEqual(
+            [p.title() for p in gubutil.DeduplicatedPages(iter(pages))],
+            ["File:A.jpg", "File:B.jpg", "File:C.jpg"])
+
+class PrefetchTests(unittest.TestCase):
+    def test_prefetch(self):
+        def fetch(page):
+            if page._pageid == 3: raise ValueError
+            return {'n': page._pageid * 10}
+        pages = [FakePage(n, "File:%d.jpg" % (n,)) for n in range(20)]
+        got = list(gubutil.PrefetchingGenerator(iter(pages), fetch, window=4))
+        self.assertEqual(got, pages)
+        self.assertEqual(gubutil.prefetched(got[5], 'n', lambda: None), 50)
+        # Each item is only handed out once.
+        self.assertEqual(gubutil.prefetched(got[5], 'n', lambda: -1), -1)
+        self.assertEqual(gubutil.prefetched(got[3], 'n', lambda: -1), -1)
+
+class FakeSDCSite(object):
+    # Answers wbgetentities requests, noting the IDs asked for.
+    def __init__(self):
+        self.requests = [ ]
+    def simple_request(self, action, ids, props):
+        site = self
+        class Request(object):
+            def submit(self):
+                site.requests.append(ids)
+                return {'entities': {
+                    mediaid: ({'id': mediaid, 'missing': ''}
+                              if mediaid == 'M3' else
+                              {'id': mediaid, 'statements': {'P1': mediaid}})
+                    for mediaid in ids }}
+        return Request()
+
+class SDCTests(unittest.TestCase):
+    def test_batches(self):
+        site = FakeSDCSite()
+        pages = [FakePage(n, "File:%d.jpg" % (n,)) for n in range(1, 8)]
+        for page in pages:
+            page.site = site
+            page.pageid = page._pageid
+        # This one doesn't know its page ID yet.
+        del pages[4]._pageid
+        got = list(gubutil.SDCPreloadingGenerator(iter(pages), groupsize=5))
+        self.assertEqual(got, pages)
+        self.assertEqual(site.requests,
+                         [['M1', 'M2', 'M3', 'M4'], ['M6', 'M7']])
+        self.assertEqual(pages[1].prefetched['sdc'], {'P1': 'M2'})
+        self.assertEqual(pages[2].prefetched['sdc'], { })
+        self.assertFalse(hasattr(pages[4], 'prefetched'))
+    def test_geograph_file_pages(self):
+        # Pages made from the category index (or a categorymembers
+        # query) know their page IDs, so they're loaded in one batch.
+        class FakeFilePage(object):
+            def __init__(self, site, title):
+                self.site = site
+                self._title = title
+            @property
+            def pageid(self):
+                return self._pageid
+        site = FakeSDCSite()
+        oldclass = gubutil.pywikibot.FilePage
+        gubutil.pywikibot.FilePage = FakeFilePage
+        try:
+            pages = [gubutil.geograph_file_page(site, "File:%d.jpg" % (n,),
+                                                n, 1000 + n)
+                     for n in range(1, 6)]
+        finally:
+            gubutil.pywikibot.FilePage = oldclass
+        got = list(gubutil.SDCPreloadingGenerator(iter(pages)))
+        self.assertEqual(got, pages)
+        self.assertEqual(site.requests, [['M1', 'M2', 'M3', 'M4', 'M5']])
+        self.assertEqual(pages[4].gridimage_id, 1005)
+        self.assertEqual(pages[4].prefetched['sdc'], {'P1': 'M5'})
+
+class PageStateTests(unittest.TestCase):
+    def test_fingerprint(self):
+        row = dict(gridimage_id=1, title="A", last_modified="2024-01-01",
+                   camera_lat=51.0)
+        fp = gubutil.row_fingerprint(row, 1)
+        self.assertEqual(gubutil.row_fingerprint(
+            dict(row, last_modified="2024-02-01", camera_lat=52.0), 1), fp)
+        self.assertNotEqual(gubutil.row_fingerprint(dict(row, title="B"), 1),
+                            fp)
+        self.assertNotEqual(gubutil.row_fingerprint(row, 2), fp)
+        self.assertIsNone(gubutil.row_fingerprint(None, 1))
+    def test_states(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "state.sqlite3")
+            states = gubutil.PageStates('test', path)
+            self.assertIsNone(states.get(12))
+            states.set(12, 345, 6789, "abc")
+            states.set(12, 346, 6789, "abd")
+            self.assertEqual(gubutil.PageStates('test', path).get(12),
+                             (346, 6789, "abd"))
+            self.assertIsNone(gubutil.PageStates('other', path).get(12))
+    def test_checkpoints(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "state.sqlite3")
+            checkpoints = gubutil.Checkpoints('test', path)
+            checkpoints.final['commons'] = "2024-01-09T00:00:00Z"
+            pages = [FakePage(n, "File:%d.jpg" % (n,)) for n in range(3)]
+            for n, page in enumerate(pages):
+                page.checkpoint = ('commons', "2024-01-0%dT00:00:00Z" % (n,))
+            gen = gubutil.CheckpointingGenerator(iter(pages), checkpoints)
+            next(gen)
+            next(gen)
+            # The bot has finished with the first page.
+            self.assertEqual(gubutil.Checkpoints('test', path).get('commons'),
+                             "2024-01-01T00:00:00Z")
+            list(gen)
+            self.assertEqual(gubutil.Checkpoints('test', path).get('commons'),
+                             "2024-01-09T00:00:00Z")
+            self.assertIsNone(checkpoints.get('geograph'))
+
+class FakeThrottle(object):
+    def __init__(self):
+        self.writedelay = 10
+        self.retry_after = 0
+        self.lags = 0
+    def lag(self, lagtime=None):
+        self.lags += 1
+
+class FakeWriteSite(object):
+    def __init__(self):
+        self.throttle = FakeThrottle()
+
+class EditSchedulerTests(unittest.TestCase):
+    def test_order(self):
+        site = FakeWriteSite()
+        scheduler = gubutil.EditScheduler(site, workers=3, gap=0)
+        self.assertEqual(site.throttle.writedelay, 0)
+        written = [ ]
+        done = [ ]
+        for n in range(30):
+            scheduler.submit(n % 5, lambda n=n: written.append(n))
+            if n == 20:
+                scheduler.call_when_done(lambda: done.append(len(written)))
+        scheduler.close()
+        self.assertEqual(sorted(written), list(range(30)))
+        for key in range(5):
+            self.assertEqual([n for n in written if n % 5 == key],
+                             list(range(key, 30, 5)))
+        self.assertGreaterEqual(done[0], 21)
+    def test_backoff(self):
+        site = FakeWriteSite()
+        scheduler = gubutil.EditScheduler(site, workers=1, gap=0,
+                                          max_gap=0.01)
+        def lagged():
+            site.throttle.lag(5)
+        scheduler.submit(1, lagged)
+        scheduler.close()
+        self.assertEqual(site.throttle.lags, 1)
+        self.assertEqual(scheduler.backoffs, 1)
+        # It backed off during the write, so the gap doesn't shrink.
+        self.assertEqual(scheduler.gap, 0.01)
+    def test_retry_after(self):
+        site = FakeWriteSite()
+        scheduler = gubutil.EditScheduler(site, workers=1, gap=0,
+                                          max_gap=0.01)
+        # As pywikibot does for every response, in whichever thread.
+        site.throttle.retry_after = 0
+        self.assertEqual(scheduler.backoffs, 0)
+        site.throttle.retry_after = 5
+        self.assertEqual(site.throttle.retry_after, 5)
+        self.assertEqual(scheduler.backoffs, 1)
+        self.assertEqual(scheduler.gap, 0.01)
+        scheduler.close()
+    def test_min_gap(self):
+        site = FakeWriteSite()
+        scheduler = gubutil.EditScheduler(site, workers=2, gap=0.004,
+                                          min_gap=0.002)
+        for n in range(30):
+            scheduler.submit(n, lambda: None)
+        scheduler.close()
+        # Closer together than -pt, but never closer than min_gap.
+        self.assertEqual(scheduler.gap, 0.002)
+        # A put throttle below min_gap is left alone.
+        scheduler = gubutil.EditScheduler(site, workers=1, gap=0.001)
+        scheduler.submit(1, lambda: None)
+        scheduler.close()
+        self.assertEqual(scheduler.gap, 0.001)
+    def test_failure(self):
+        site = FakeWriteSite()
+        scheduler = gubutil.EditScheduler(site, workers=2, gap=0)
+        written = [ ]
+        done = [ ]
+        def fail():
+            raise ValueError
+        scheduler.submit(1, fail)
+        scheduler.submit(1, lambda: written.append(1))
+        scheduler.call_when_done(lambda: done.append(True))
+        with self.assertRaises(gubutil.WriteFailed) as cm:
+            scheduler.close()
+        self.assertEqual(cm.exception.key, 1)
+        self.assertIsInstance(cm.exception.__cause__, ValueError)
+        # Nothing else is written, and nothing recorded as done.
+        self.assertEqual(written, [ ])
+        self.assertEqual(done, [ ])
+    def test_failure_stops(self):
+        site = FakeWriteSite()
+        scheduler = gubutil.EditScheduler(site, workers=1, gap=0)
+        failed = threading.Event()
+        def fail():
+            failed.set()
+            raise ValueError
+        scheduler.submit(1, fail)
+        failed.wait()
+        # Every later submission is refused, naming the page that failed.
+        for key in (2, 3):
+            with self.assertRaises(gubutil.WriteFailed) as cm:
+                while True:
+                    scheduler.submit(key, lambda: None)
+            self.assertEqual(cm.exception.key, 1)
+        # Having been reported, it isn't raised again.
+        scheduler.close()
+    def test_synchronous(self):
+        site = FakeWriteSite()
+        scheduler = gubutil.EditScheduler(site, workers=0)
+        written = [ ]
+        scheduler.submit(1, lambda: written.append(1))
+        self.assertEqual(written, [1])
+        self.assertEqual(site.throttle.writedelay, 10)
+
+class SizeSnapshotTests(unittest.TestCase):
+    def test_round_trip(self):
+        geograph_import = load_importer()
+        db = sqlite3.connect(":memory:")
+        geograph_import.create_tables(db)
+        db.executemany("INSERT INTO gridimage_size VALUES (?, ?, ?, ?, ?, ?)",
+                       [(3, 640, 480, 4000, 3000, "no"), (7, 480, 640, 0, 0, "")])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "geograph.sizes")
+            geograph_import.write_size_snapshot(db, path)
+            sizes = gubutil.SizeSnapshot(path)
+            self.assertEqual(sizes.get(3), (640, 480, 4000, 3000))
+            self.assertEqual(sizes.get(7), (480, 640, 0, 0))
+            self.assertEqual(sizes.get(5), None)
+            self.assertEqual(sizes.get(8), None)
+            self.assertEqual(sizes.get(-1), None)
+            del sizes
+
+class GeographDBTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, "geograph test.sqlite3")
+        with sqlite3.connect(path) as db:
+            db.execute("CREATE TABLE t (x)")
+            db.execute("INSERT INTO t VALUES (1)")
+        db.close()
+        self.oldpath = os.environ.get('geograph_db')
+        os.environ['geograph_db'] = path
+    def tearDown(self):
+        if self.oldpath == None:
+            del os.environ['geograph_db']
+        else:
+            os.environ['geograph_db'] = self.oldpath
+        self.tmpdir.cleanup()
+    def test_read_only(self):
+        db = gubutil.connect_geograph_db()
+        self.assertEqual(db.execute("SELECT x FROM t").fetchone()['x'], 1)
+        with self.assertRaises(sqlite3.OperationalError):
+            db.execute("INSERT INTO t VALUES (2)")
+        db.close()
+    def test_per_thread(self):
+        # Run in a new thread so as not to disturb this thread's
+        # connection.
+        dbs = [ ]
+        def worker():
+            dbs.append(gubutil.geograph_db())
+            dbs.append(gubutil.geograph_db())
+        for i in range(2):
+            t = threading.Thread(target=worker)
+            t.start()
+            t.join()
+        self.assertIs(dbs[0], dbs[1])
+        self.assertIsNot(dbs[0], dbs[2])
+
+if __name__ == '__main__':
+    unittest.main()
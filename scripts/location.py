@@ -1,6 +1,9 @@
 from __future__ import division, print_function, unicode_literals
 
-import pyproj
+from array import array
+from functools import lru_cache
+import threading
+import time
 
 import mwparserfromhell
 from mwparserfromhell.nodes.template import Template
@@ -8,20 +11,30 @@ from mwparserfromhell.nodes.text import Text
 from mwparserfromhell.wikicode import Wikicode
 import requests
 
-from gubutil import tlgetall, tlgetone
+from gubutil import tlgetall, tlgetone, tlchanged
+from phases import phase
 
 # Geograph Britain and Ireland uses the British National Grid in Great
 # Britain and the Irish Grid in Ireland.
 
 # epsg:27700 is the British National Grid
-bng = pyproj.CRS.from_epsg(27700)
+bng = "EPSG:27700"
 # epsg:29903 is the Irish Grid
-ig = pyproj.CRS.from_epsg(29903)
-wgs84 = pyproj.CRS.from_epsg(4326)
-transformers = {
-    bng: pyproj.Transformer.from_crs(bng, wgs84),
-    ig:  pyproj.Transformer.from_crs(ig, wgs84),
-}
+ig = "EPSG:29903"
+wgs84 = "EPSG:4326"
+
+# pyproj is slow to import and its transformers are slow to set up, so
+# that waits until something actually needs converting.  Before pyproj
+# 3.1, transformers can't be shared between threads, so update_metadata's
+# planning threads each get their own.
+pyproj_local = threading.local()
+
+def transformer(grid):
+    transformers = pyproj_local.__dict__.setdefault('transformers', { })
+    if grid not in transformers:
+        import pyproj
+        transformers[grid] = pyproj.Transformer.from_crs(grid, wgs84)
+    return transformers[grid]
 
 gridletters = [
     "ABCDE",
@@ -74,6 +87,37 @@ class MapItSettings(object):
         self.allowed = allowed
         self.used = False
 
+# Global MapIt is a free service, and update_metadata can be planning
+# several pages at once, so requests to it go one at a time, at least
+# mapit_interval seconds apart.  If it asks us to slow down (429 or
+# 503), wait as long as it says, double the interval, and try again.
+mapit_lock = threading.Lock()
+mapit_interval = 1.0
+mapit_max_interval = 60.0
+mapit_attempts = 5
+mapit_next = 0.0
+
+def mapit_point(lonstr, latstr):
+    global mapit_interval, mapit_next
+    with mapit_lock:
+        for attempt in range(mapit_attempts):
+            time.sleep(max(0.0, mapit_next - time.monotonic()))
+            with phase('mapit'):
+                r = requests.get('http://global.mapit.mysociety.org'
+                                 '/point/4326/{},{}'.format(lonstr,latstr))
+            wait = 0.0
+            if r.status_code in (429, 503):
+                mapit_interval = min(mapit_max_interval, mapit_interval * 2)
+                try:
+                    wait = float(r.headers.get('Retry-After', 0))
+                except ValueError:
+                    pass # An HTTP date: just use the interval.
+            mapit_next = time.monotonic() + max(wait, mapit_interval)
+            if r.status_code not in (429, 503):
+                break
+    r.raise_for_status()
+    return r.json()
+
 def region_of(grid, e, n, latstr, lonstr, mapit = None):
     # First, see if it's obvious.  Look for a myriad wholly within a single
     # region (including territorial waters).
@@ -89,10 +133,7 @@ def region_of(grid, e, n, latstr, lonstr, mapit = None):
         if igr_from_en(e, n, 0) in ('M', 'N', 'R', 'S'): return 'IE'
 
     if mapit and mapit.allowed:
-        r = requests.get('http://global.mapit.mysociety.org'
-                         '/point/4326/{},{}'.format(lonstr,latstr))
-        r.raise_for_status()
-        j = r.json()
+        j = mapit_point(lonstr, latstr)
         for area in j.values():
             if 'codes' in area and 'iso3166_1' in area['codes']:
                 mapit.used = True
@@ -111,7 +152,7 @@ def source_from_grid(grid, e, n, digits):
         src += "-irishgrid({})".format(igr_from_en(e, n, digits))
     return src
 
-def latlon_from_grid(grid, e, n, digits, use6fig):
+def square_centre(e, n, digits):
     # A grid reference in textual form, like SO8001, represents a
     # square on the ground whose size depends on the number of digits.
     # So SO8001 is the 1km square whose SW corner is at
@@ -123,7 +164,14 @@ def latlon_from_grid(grid, e, n, digits, use6fig):
     square = 10**(5-digits/2)
     e = (e // square + 0.5) * square
     n = (n // square + 0.5) * square
-    lat, lon = transformers[grid].transform(e, n)
+    return e, n, square
+
+def latlon_from_grid(grid, e, n, digits, use6fig):
+    e, n, square = square_centre(e, n, digits)
+    lat, lon = transformer(grid).transform(e, n)
+    return format_latlon(lat, lon, digits, square, use6fig)
+
+def format_latlon(lat, lon, digits, square, use6fig):
     # At 6dp, one ulp in latitude is about 11cm.  In longitude, about
     # 6cm.  Thus 6dp is enough to distinguish 10-figure GRs in latitude,
     # and 5dp is enough in longitude.
@@ -139,9 +187,14 @@ def latlon_from_grid(grid, e, n, digits, use6fig):
 def location_from_grid(grid, e, n, digits, view_direction, use6fig,
                        mapit = None):
     latstr, lonstr, prec = latlon_from_grid(grid, e, n, digits, use6fig)
+    return location_from_latlon(
+        latstr, lonstr, prec, source_from_grid(grid, e, n, digits),
+        region_of(grid, e, n, latstr, lonstr, mapit), view_direction)
+
+def location_from_latlon(latstr, lonstr, prec, source, region,
+                         view_direction):
     precstr = "{:g}".format(prec)
-    paramstr = "source:" + source_from_grid(grid, e, n, digits)
-    region = region_of(grid, e, n, latstr, lonstr, mapit)
+    paramstr = "source:" + source
     if region != None:
         paramstr += "_region:{}".format(region)
     if view_direction != None:
@@ -155,6 +208,9 @@ def location_from_grid(grid, e, n, digits, view_direction, use6fig,
 
 def statement_from_grid(grid, e, n, digits, view_direction, use6fig):
     latstr, lonstr, prec = latlon_from_grid(grid, e, n, digits, use6fig)
+    return statement_from_latlon(latstr, lonstr, prec, view_direction)
+
+def statement_from_latlon(latstr, lonstr, prec, view_direction):
     # The precision of a Wikidata GlobeCoordinateValue is expressed in
     # degrees and must be the same in latitude and longitude.  A metre
     # is about 0.00002° in longitude at our kind of latitude.
@@ -208,30 +264,131 @@ def camera_grid_from_row(row, mapit = None):
     use6fig = bool(row['use6fig'])
     return grid, e, n, digits, heading, use6fig
 
+# Locations precomputed by precompute_locations.py.  A row from
+# gubutil.get_geograph_row carries them if they're up to date.  The
+# camera columns are NULL if there's no usable camera location, and the
+# object columns are NULL if the object location should be omitted.
+# Bump location_version whenever a change here would alter them.
+location_version = 1
+
+def has_precomputed_location(row):
+    return ('location_version' in row.keys() and
+            row['location_version'] == location_version)
+
+def precompute_locations(rows):
+    # Work out the camera and object locations for many rows at once,
+    # transforming all the co-ordinates on each grid in a single call
+    # to pyproj.  Returns a list of tuples matching the columns of
+    # gridimage_location.  Rows that can't be handled are left out, so
+    # that the bots will report the problem when they get to them.
+    located = [ ]
+    batches = { }
+    for row in rows:
+        try:
+            camera = camera_grid_from_row(row)
+            if camera != None and camera[3] <= 4: camera = None
+            obj = object_grid_from_row(row)
+            if obj[3] == 4 and camera != None: obj = None
+        except (KeyError, ValueError, TypeError, IndexError):
+            continue
+        entry = [row['gridimage_id'], location_version] + [None] * 10
+        for i, g in ((2, camera), (7, obj)):
+            if g == None: continue
+            grid, e, n, digits, heading, use6fig = g
+            ce, cn, square = square_centre(e, n, digits)
+            batches.setdefault(grid, []).append(
+                (entry, i, ce, cn, digits, square, use6fig))
+            entry[i + 3] = source_from_grid(grid, e, n, digits)
+            entry[i + 4] = region_of(grid, e, n, None, None)
+        heading = int(row['view_direction'])
+        entry.append(None if heading == -1 else heading)
+        located.append(entry)
+    for grid, batch in batches.items():
+        lats, lons = transformer(grid).transform(
+            array('d', (b[2] for b in batch)),
+            array('d', (b[3] for b in batch)))
+        for (entry, i, ce, cn, digits, square, use6fig), lat, lon in (
+                zip(batch, lats, lons)):
+            entry[i:i + 3] = format_latlon(lat, lon, digits, square, use6fig)
+    return [tuple(entry) for entry in located]
+
+class RowLocations(object):
+    # The camera and object locations of a Geograph row, as templates
+    # and as structured data statements.  Each point is transformed
+    # (or looked up in the precomputed columns) only once, and MapIt
+    # is asked about it at most once, however many times the bot asks
+    # for it.  Templates and statements are made afresh each time,
+    # since callers change them.
+    def __init__(self, row, mapit = None):
+        self.row = row
+        self.mapit = mapit
+        self.points = { }
+    def point(self, which):
+        # which is 'camera' or 'object'.  Returns a dict describing
+        # the point, or None if there shouldn't be a location.
+        if which not in self.points:
+            self.points[which] = self.find_point(which)
+        return self.points[which]
+    def find_point(self, which):
+        row = self.row
+        if has_precomputed_location(row):
+            if row[which + '_lat'] == None: return None
+            return dict(latstr=row[which + '_lat'], lonstr=row[which + '_lon'],
+                        prec=row[which + '_prec'],
+                        source=row[which + '_source'],
+                        region=row[which + '_region'], heading=row['heading'])
+        # Consensus on Commons seems to be that 1km is not sufficient
+        # for camera location, but is acceptable for object location
+        # if that's all we've got.
+        if which == 'camera':
+            grid_location = camera_grid_from_row(row)
+            if grid_location == None or grid_location[3] <= 4: return None
+        else:
+            grid_location = object_grid_from_row(row)
+            if grid_location[3] == 4 and self.point('camera') != None:
+                return None
+        grid, e, n, digits, heading, use6fig = grid_location
+        latstr, lonstr, prec = latlon_from_grid(grid, e, n, digits, use6fig)
+        return dict(latstr=latstr, lonstr=lonstr, prec=prec,
+                    source=source_from_grid(grid, e, n, digits),
+                    region=region_of(grid, e, n, latstr, lonstr),
+                    heading=heading)
+    def region(self, which):
+        p = self.point(which)
+        if (p['region'] == None and self.mapit and self.mapit.allowed and
+            not p.get('asked_mapit')):
+            # Not obvious from the myriad, so ask MapIt.
+            if which == 'camera':
+                grid, e, n = camera_grid_from_row(self.row)[:3]
+            else:
+                grid, e, n = object_grid_from_row(self.row)[:3]
+            p['region'] = region_of(grid, e, n, p['latstr'], p['lonstr'],
+                                    self.mapit)
+            p['asked_mapit'] = True
+        return p['region']
+    def location(self, which):
+        p = self.point(which)
+        if p == None: return None
+        t = location_from_latlon(p['latstr'], p['lonstr'], p['prec'],
+                                 p['source'], self.region(which), p['heading'])
+        if which == 'object':
+            t.name = mwparserfromhell.parse("Object location")
+        return t
+    def statement(self, which):
+        p = self.point(which)
+        if p == None: return None
+        s = statement_from_latlon(p['latstr'], p['lonstr'], p['prec'],
+                                  p['heading'])
+        if which == 'object':
+            s['mainsnak']['property'] = "P9149"
+        add_references_to_statement(s, self.row)
+        return s
+
 def location_from_row(row, mapit = None):
-    camera_grid = camera_grid_from_row(row)
-    if camera_grid == None: return None
-    grid, e, n, digits, heading, use6fig = camera_grid
-    # Consensus on Commons seems to be that 1km is not sufficient for
-    # camera location, but is acceptable for object location if that's
-    # all we've got.
-    if digits <= 4:
-        return None
-    t = location_from_grid(grid, e, n, digits, heading, use6fig, mapit)
-    return t
+    return RowLocations(row, mapit).location('camera')
 
 def camera_statement_from_row(row):
-    camera_grid = camera_grid_from_row(row)
-    if camera_grid == None: return None
-    grid, e, n, digits, heading, use6fig = camera_grid
-    # Consensus on Commons seems to be that 1km is not sufficient for
-    # camera location, but is acceptable for object location if that's
-    # all we've got.
-    if digits <= 4:
-        return None
-    s = statement_from_grid(grid, e, n, digits, heading, use6fig)
-    add_references_to_statement(s, row)
-    return s
+    return RowLocations(row).statement('camera')
 
 def object_grid_from_row(row):
     # The "subject location" in Geograph isn't necessarily the main
@@ -254,27 +411,10 @@ def object_grid_from_row(row):
     return grid, e, n, digits, heading, use6fig
 
 def object_location_from_row(row, mapit = None):
-    grid, e, n, digits, heading, use6fig = object_grid_from_row(row)
-    # Consensus on Commons seems to be that 1km is not sufficient for
-    # camera location, but is acceptable for object location if that's
-    # all we've got.
-    if digits == 4 and location_from_row(row) != None:
-        return None
-    t = location_from_grid(grid, e, n, digits, heading, use6fig, mapit)
-    t.name = mwparserfromhell.parse("Object location")
-    return t
+    return RowLocations(row, mapit).location('object')
 
 def object_statement_from_row(row):
-    grid, e, n, digits, heading, use6fig = object_grid_from_row(row)
-    # Consensus on Commons seems to be that 1km is not sufficient for
-    # camera location, but is acceptable for object location if that's
-    # all we've got.
-    if digits == 4 and camera_statement_from_row(row) != None:
-        return None
-    s = statement_from_grid(grid, e, n, digits, heading, use6fig)
-    s['mainsnak']['property'] = "P9149"
-    add_references_to_statement(s, row)
-    return s
+    return RowLocations(row).statement('object')
 
 def add_references_to_statement(s, row):
     refsnaks = {
@@ -369,14 +509,27 @@ def statement_matches_template(statement, template):
     return True
 
 # This is overkill, but since I've got pyproj lying around...
-geod = pyproj.Geod(ellps='WGS84')
+def geod():
+    try:
+        return pyproj_local.geod
+    except AttributeError:
+        import pyproj
+        pyproj_local.geod = pyproj.Geod(ellps='WGS84')
+        return pyproj_local.geod
+
 def az_dist_between_locations(loc1, loc2):
     lat1 = float(str(loc1.get(1)))
     lat2 = float(str(loc2.get(1)))
     lon1 = float(str(loc1.get(2)))
     lon2 = float(str(loc2.get(2)))
+    return az_dist_between_points(lon1, lat1, lon2, lat2)
+
+# update_metadata asks about the same pair of locations once to decide
+# whether to move one and again to describe the move.
+@lru_cache(maxsize=1024)
+def az_dist_between_points(lon1, lat1, lon2, lat2):
     # az12, az21, dist
-    return geod.inv(lon1, lat1, lon2, lat2)
+    return geod().inv(lon1, lat1, lon2, lat2)
 
 def format_row(row):
     # Format a database row for use in an edit summary.
@@ -437,17 +590,21 @@ def replace_templates(tree, new, names):
     tree.replace(olds[0], new)
     for o in olds[1:]:
         tree.remove(o)
+    tlchanged(tree)
 
 def insert_template_after(tree, new, names):
     olds = tlgetall(tree, names)
     tree.insert_after(olds[0], Wikicode([Text("\n"), new]))
+    tlchanged(tree)
 
 def insert_template_before(tree, new, names):
     olds = tlgetall(tree, names)
     tree.insert_before(olds[0], Wikicode([new, Text("\n")]))
+    tlchanged(tree)
 
 def insert_template_at_start(tree, new):
     tree.insert(0, Wikicode([new, Text("\n")]))
+    tlchanged(tree)
 
 def get_location(tree):
     return tlgetone(tree, loctls)
@@ -456,6 +613,7 @@ def set_location(tree, loc):
     if loc == None:
         for tl in tlgetall(tree, loctls):
             tree.remove(tl)
+        tlchanged(tree)
         return
     try:
         replace_templates(tree, loc, loctls)
@@ -478,6 +636,7 @@ def set_object_location(tree, oloc):
     if oloc == None:
         for tl in tlgetall(tree, objtls):
             tree.remove(tl)
+        tlchanged(tree)
         return
     try:
         replace_templates(tree, oloc, objtls)
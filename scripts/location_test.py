@@ -2,14 +2,15 @@ from __future__ import division, print_function, unicode_literals
 
 import unittest
 from gubutil import tlgetone
-from location import (bng, ig, location_from_grid, statement_from_grid,
+import location
+from location import (RowLocations, bng, ig, location_from_grid, statement_from_grid,
                       location_from_row, object_location_from_row,
                       camera_statement_from_row,
                       object_statement_from_row,
                       en_from_gr, bngr_from_en, format_row,
                       set_location, set_object_location,
                       get_location, get_object_location,
-                      statement_matches_template)
+                      statement_matches_template, precompute_locations)
 import mwparserfromhell
 from mwparserfromhell.nodes.template import Template
 
@@ -20,6 +21,23 @@ class FromGridTests(unittest.TestCase):
             '{{Location|51.71051|-2.2766|'
             'source:geograph-osgb36(SO80980134)_region:GB-EAW_heading:292|'
             'prec=100}}')
+    def test_threads(self):
+        # Each thread has its own transformer, which gives the same
+        # answers as everyone else's.
+        import threading
+        results = [ ]
+        def convert():
+            results.append((location.transformer(bng),
+                location_from_grid(bng, 380980, 201340, 8, 292, True)))
+        threads = [threading.Thread(target=convert) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        (t0, l0), (t1, l1) = results
+        self.assertIsNot(t0, t1)
+        self.assertEqual(l0, l1)
+        self.assertIs(location.transformer(bng), location.transformer(bng))
     def test_stmt_from_grid(self):
         a = statement_from_grid(bng, 380980, 201340, 8, 292, True)
         self.assertEqual(a, {
@@ -186,6 +204,116 @@ class FromRowTests(unittest.TestCase):
         self.assertEqual(f,
             "subject SY8379")
 
+class PrecomputedTests(unittest.TestCase):
+    # Precomputed locations must give the same answers as working them
+    # out from the row.
+    columns = ('gridimage_id', 'location_version',
+               'camera_lat', 'camera_lon', 'camera_prec',
+               'camera_source', 'camera_region',
+               'object_lat', 'object_lon', 'object_prec',
+               'object_source', 'object_region', 'heading')
+    def setUp(self):
+        FromRowTests.setUp(self)
+        self.rows = [self.full_row, self.min_row, self.low_row,
+                     self.mid_row, self.high_row, self.supp_row]
+        for row in self.rows:
+            row['last_modified'] = "2023-05-01 02:03:04Z"
+        self.precomputed = [dict(row, **dict(zip(self.columns, located)))
+                            for row, located in
+                            zip(self.rows, precompute_locations(self.rows))]
+    def test_precomputed(self):
+        self.assertEqual(len(self.precomputed), len(self.rows))
+        for row, pre in zip(self.rows, self.precomputed):
+            self.assertEqual(row['gridimage_id'], pre['gridimage_id'])
+            for fn in (location_from_row, object_location_from_row):
+                self.assertEqual(str(fn(row)), str(fn(pre)))
+            for fn in (camera_statement_from_row, object_statement_from_row):
+                self.assertEqual(fn(row), fn(pre))
+    def test_unhandled_row(self):
+        self.full_row['reference_index'] = 0
+        self.assertEqual(len(precompute_locations(self.rows)),
+                         len(self.rows) - 1)
+
+class RowLocationsTests(unittest.TestCase):
+    def setUp(self):
+        FromRowTests.setUp(self)
+        self.full_row['last_modified'] = "2023-05-01 02:03:04Z"
+        self.transforms = 0
+        self.latlon_from_grid = location.latlon_from_grid
+        def counting(*args):
+            self.transforms += 1
+            return self.latlon_from_grid(*args)
+        location.latlon_from_grid = counting
+    def tearDown(self):
+        location.latlon_from_grid = self.latlon_from_grid
+    def test_once(self):
+        locations = RowLocations(self.full_row)
+        for i in range(2):
+            self.assertEqual(str(locations.location('camera')),
+                '{{Location|51.71051|-2.2766|'
+                'source:geograph-osgb36(SO80980134)_region:GB-EAW_heading:292|'
+                'prec=100}}')
+            self.assertEqual(str(locations.location('object')),
+                '{{Object location|51.71069|-2.2773|'
+                'source:geograph-osgb36(SO80930136)_region:GB-EAW_heading:292|'
+                'prec=100}}')
+            s = locations.statement('object')
+            self.assertEqual(s['mainsnak']['property'], "P9149")
+            s['id'] = "changed"
+        self.assertNotIn('id', locations.statement('object'))
+        self.assertEqual(locations.statement('camera'),
+                         camera_statement_from_row(self.full_row))
+        # One for each point, plus one for camera_statement_from_row.
+        self.assertEqual(self.transforms, 3)
+
+class FakeMapItResponse(object):
+    def __init__(self, status_code, headers={}):
+        self.status_code = status_code
+        self.headers = headers
+    def raise_for_status(self):
+        pass
+    def json(self):
+        return {'1': {'codes': {'iso3166_1': 'IM'}}}
+
+class MapItTests(unittest.TestCase):
+    def setUp(self):
+        self.saved = (location.requests, location.mapit_interval,
+                      location.mapit_next)
+        location.mapit_interval = 0.01
+        self.active = 0
+        self.overlapped = False
+        self.responses = [FakeMapItResponse(429, {'Retry-After': "0"})]
+        test = self
+        class FakeRequests(object):
+            def get(self, url):
+                test.active += 1
+                test.overlapped |= test.active > 1
+                location.time.sleep(0.01)
+                test.active -= 1
+                if test.responses:
+                    return test.responses.pop()
+                return FakeMapItResponse(200)
+        location.requests = FakeRequests()
+    def tearDown(self):
+        (location.requests, location.mapit_interval,
+         location.mapit_next) = self.saved
+    def test_one_at_a_time(self):
+        import threading
+        results = [ ]
+        def ask():
+            mapit = location.MapItSettings(allowed=True)
+            results.append(location.region_of(None, 0, 0, "54.2", "-4.5",
+                                              mapit))
+        threads = [threading.Thread(target=ask) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertFalse(self.overlapped)
+        # Including the one that was asked to slow down.
+        self.assertEqual(results, ['IM'] * 4)
+        self.assertEqual(location.mapit_interval, 0.02)
+
 class EditingTest1(unittest.TestCase):
     def setUp(self):
         self.tree = mwparserfromhell.parse("{{Information}}\n{{location dec}}")
@@ -0,0 +1,102 @@
+# Where the bots' time goes.  Each phase of the work (parsing,
+# fetching from Geograph, saving, and so on) is timed with
+#
+#   with phase('parse'):
+#       ...
+#
+# and report() at the end of a run prints percentiles and a histogram
+# for each phase, and writes them to a JSON file so that one week's run
+# can be compared with the last.  Phases are timed from whichever
+# thread runs them, so with prefetching or background writes they
+# overlap, and their totals can add up to more than the run took.
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+lock = threading.Lock()
+durations = { }
+started = time.time()
+
+def record(name, seconds):
+    with lock:
+        durations.setdefault(name, [ ]).append(seconds)
+
+@contextmanager
+def phase(name):
+    starttime = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - starttime)
+
+def timed_generator(gen, name):
+    # Time how long each item takes to come out of gen.
+    gen = iter(gen)
+    while True:
+        with phase(name):
+            try:
+                item = next(gen)
+            except StopIteration:
+                return
+        yield item
+
+def percentile(values, p):
+    # values must be sorted.  Nearest-rank, so always one of values.
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+# Histogram buckets: upper bounds in seconds.
+buckets = (0.001, 0.01, 0.1, 1, 10, float('inf'))
+bucket_labels = ("<1ms", "<10ms", "<100ms", "<1s", "<10s", ">=10s")
+
+def summary():
+    with lock:
+        snapshot = {name: sorted(d) for name, d in durations.items()}
+    result = { }
+    for name, d in snapshot.items():
+        histogram = [0] * len(buckets)
+        for seconds in d:
+            histogram[next(i for i, b in enumerate(buckets)
+                           if seconds < b)] += 1
+        result[name] = dict(
+            count=len(d), total=sum(d), mean=sum(d) / len(d),
+            p50=percentile(d, 50), p90=percentile(d, 90),
+            p99=percentile(d, 99), max=d[-1],
+            histogram=dict(zip(bucket_labels, histogram)))
+    return result
+
+def report_path(task):
+    return os.path.join(os.environ.get("gub_phases_dir", "."),
+                        "%s-phases.json" % (task,))
+
+def report(task, path=None):
+    # Print the summary, and write it (with when this run started and
+    # how long it took) to path, replacing the previous run's.  The
+    # previous run's p90 is printed alongside for comparison.
+    path = path or report_path(task)
+    phases = summary()
+    elapsed = time.time() - started
+    try:
+        with open(path) as f:
+            previous = json.load(f)['phases']
+    except (OSError, ValueError, KeyError):
+        previous = { }
+    print("%s: %.0f s; time per phase in ms (phases can overlap):" %
+          (task, elapsed))
+    print("  %-20s %7s %9s %8s %8s %8s %8s %8s  %s" %
+          ("phase", "count", "total s", "p50", "p90", "last p90", "p99",
+           "max", " ".join(bucket_labels)))
+    for name, p in sorted(phases.items(), key=lambda i: -i[1]['total']):
+        last = "-"
+        if name in previous:
+            last = "%.1f" % (previous[name]['p90'] * 1000,)
+        print("  %-20s %7d %9.1f %8.1f %8.1f %8s %8.1f %8.1f  %s" %
+              (name, p['count'], p['total'], p['p50'] * 1000,
+               p['p90'] * 1000, last, p['p99'] * 1000, p['max'] * 1000,
+               " ".join(str(p['histogram'][label])
+                        for label in bucket_labels)))
+    with open(path, 'w') as f:
+        json.dump(dict(task=task, started=started, elapsed=elapsed,
+                       phases=phases), f, indent=1, sort_keys=True)
@@ -0,0 +1,58 @@
+from __future__ import division, print_function, unicode_literals
+
+import io
+import json
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+import phases
+
+class PhasesTests(unittest.TestCase):
+    def setUp(self):
+        phases.durations.clear()
+    def tearDown(self):
+        phases.durations.clear()
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(phases.percentile(values, 50), 50)
+        self.assertEqual(phases.percentile(values, 90), 90)
+        self.assertEqual(phases.percentile(values, 100), 100)
+        self.assertEqual(phases.percentile([7], 99), 7)
+    def test_summary(self):
+        for seconds in (0.0005, 0.002, 0.003, 0.5, 20):
+            phases.record('save', seconds)
+        with phases.phase('parse'):
+            pass
+        s = phases.summary()
+        self.assertEqual(s['parse']['count'], 1)
+        self.assertEqual(s['save']['count'], 5)
+        self.assertEqual(s['save']['p50'], 0.003)
+        self.assertEqual(s['save']['max'], 20)
+        self.assertEqual(list(s['save']['histogram'].values()),
+                         [1, 2, 0, 1, 0, 1])
+    def test_timed_generator(self):
+        self.assertEqual(list(phases.timed_generator(range(3), 'next')),
+                         [0, 1, 2])
+        # The final, empty, call counts as well.
+        self.assertEqual(phases.summary()['next']['count'], 4)
+    def test_report(self):
+        phases.record('save', 0.25)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "test-phases.json")
+            with redirect_stdout(io.StringIO()):
+                phases.report('test', path)
+            phases.record('save', 0.5)
+            out = io.StringIO()
+            with redirect_stdout(out):
+                phases.report('test', path)
+            with open(path) as f:
+                j = json.load(f)
+        self.assertEqual(j['task'], 'test')
+        self.assertEqual(j['phases']['save']['count'], 2)
+        # The first run's p90, in ms.
+        self.assertIn(" 250.0 ", out.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
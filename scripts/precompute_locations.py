@@ -0,0 +1,48 @@
+from __future__ import division, print_function
+
+# Fill in the gridimage_location table in the Geograph database with
+# the camera and object locations of every image, so that the bots
+# don't have to work them out one page at a time.  Run this after
+# geograph_import.  It only computes rows that are missing or were
+# made by an older version of location.py, so it's cheap after an
+# incremental import.
+
+import sqlite3
+import time
+from gubutil import geograph_db_path
+from location import precompute_locations, location_version
+
+batchsize = 50000
+
+def main():
+    starttime = time.monotonic()
+    # Not the usual read-only connection, since we're writing.
+    db = sqlite3.connect(geograph_db_path())
+    db.row_factory = sqlite3.Row
+    last_id = -1
+    computed = 0
+    while True:
+        # Each batch is read completely before we write to
+        # gridimage_location, so we're never modifying a table under a
+        # running query.
+        rows = db.execute("""
+            SELECT gridimage.*
+              FROM gridimage LEFT JOIN gridimage_location AS l
+                   USING (gridimage_id)
+             WHERE gridimage_id > ? AND l.version IS NOT ?
+             ORDER BY gridimage_id LIMIT ?
+            """, (last_id, location_version, batchsize)).fetchall()
+        if not rows: break
+        last_id = rows[-1]['gridimage_id']
+        with db:
+            db.executemany("""
+                INSERT OR REPLACE INTO gridimage_location
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, precompute_locations(rows))
+        computed += len(rows)
+    db.close()
+    print("gridimage_location: %d rows computed in %.1f s" %
+          (computed, time.monotonic() - starttime))
+
+if __name__ == '__main__':
+    main()
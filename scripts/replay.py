@@ -0,0 +1,625 @@
+# An offline stand-in for Commons, Geograph and MapIt, so that the bots
+# can be run (and timed) without touching the real ones.  install()
+# routes every HTTP request made through requests, which includes all
+# of pywikibot's, to a StandIn.  That answers from a file of recorded
+# responses where it can, and otherwise from its own little model of
+# the world: some file pages on Commons and a Geograph database.
+#
+# Only as much of the MediaWiki API is modelled as the bots use.
+# Anything else gets an "unknown action" error, and is counted in
+# StandIn.unhandled so that it's easy to see what's missing.  A real
+# run can be recorded with record(), and the responses it saw served
+# back by passing the file to StandIn.
+
+from collections import Counter, defaultdict
+import hashlib
+from io import BytesIO
+import json
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+
+username = "Geograph Update Bot"
+
+def request_params(request):
+    # The query and form parameters of a prepared request, as a dict.
+    # Multipart bodies (uploads) only contribute their simple fields.
+    params = dict(parse_qsl(urlsplit(request.url).query,
+                            keep_blank_values=True))
+    body = request.body
+    if isinstance(body, bytes):
+        ctype = request.headers.get('Content-Type', '')
+        if ctype.startswith('multipart/form-data'):
+            for name, value in re.findall(
+                    rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.S):
+                params[name.decode()] = value.decode('utf-8', 'replace')
+            return params
+        body = body.decode('utf-8')
+    if body:
+        params.update(parse_qsl(body, keep_blank_values=True))
+    return params
+
+# Parameters that differ from run to run without changing the answer.
+volatile_params = frozenset((
+    'token', 'requestid', 'curtimestamp', 'maxlag', 'assert', 'format',
+    'formatversion', 'errorformat', 'utf8'))
+
+def request_key(method, url, params):
+    # What recorded responses are looked up by.
+    parts = urlsplit(url)
+    return "%s %s%s?%s" % (method, parts.netloc, parts.path, urlencode(
+        sorted((k, v) for k, v in params.items()
+               if k not in volatile_params)))
+
+def fake_jpeg(seed, size=(32, 24)):
+    # A small but real JPEG, different for each seed, so that anything
+    # decoding or hashing it works.
+    from PIL import Image
+    colour = tuple(hashlib.sha1(str(seed).encode()).digest()[:3])
+    buf = BytesIO()
+    Image.new('RGB', size, colour).save(buf, format='JPEG')
+    return buf.getvalue()
+
+def mw_time(t):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+class FilePage(object):
+    # A file description page on the stand-in Commons.
+    def __init__(self, pageid, title, text, statements=None):
+        self.pageid = pageid
+        self.title = title
+        self.statements = statements if statements != None else { }
+        self.revisions = [ ]
+        self.files = [ ]
+        self.statement_revision = 0
+        self.add_revision(text, "Uploader")
+    def add_revision(self, text, user, comment=""):
+        self.revisions.append(dict(revid=next_revid(), text=text, user=user,
+                                   comment=comment,
+                                   timestamp=mw_time(time.time())))
+        return self.revisions[-1]
+    def add_file(self, data, width, height, user, url=None):
+        name = self.title.split(":", 1)[1].replace(" ", "_")
+        self.files.append(dict(
+            timestamp=mw_time(time.time()), user=user, size=len(data),
+            width=width, height=height, sha1=hashlib.sha1(data).hexdigest(),
+            mime="image/jpeg", mediatype="BITMAP", comment="",
+            url="https://upload.wikimedia.org/wikipedia/commons/%s" % (name,),
+            descriptionurl="https://commons.wikimedia.org/wiki/%s" %
+                           (self.title.replace(" ", "_"),),
+            source=url))
+    @property
+    def latest(self):
+        return self.revisions[-1]
+
+revid_lock = threading.Lock()
+revid_counter = [1000000]
+
+def next_revid():
+    with revid_lock:
+        revid_counter[0] += 1
+        return revid_counter[0]
+
+# Enough site information for pywikibot to get going.
+siteinfo = {
+    'general': {
+        'mainpage': "Main Page", 'base':
+        "https://commons.wikimedia.org/wiki/Main_Page",
+        'sitename': "Wikimedia Commons", 'generator': "MediaWiki 1.43.0",
+        'phpversion': "8.1", 'dbtype': "mysql", 'case': "first-letter",
+        'lang': "en", 'fallback': [ ], 'rtl': False,
+        'server': "//commons.wikimedia.org",
+        'servername': "commons.wikimedia.org",
+        'articlepath': "/wiki/$1", 'scriptpath': "/w", 'script': "/w/index.php",
+        'wikiid': "commonswiki", 'time': mw_time(time.time()),
+        'timezone': "UTC", 'timeoffset': 0, 'maxuploadsize': 5368709120,
+        'legaltitlechars':
+        " %!\"$&'()*,\\-.\\/0-9:;=?@A-Z\\\\^_`a-z~\\x80-\\xFF+",
+        'invalidusernamechars': "@:>=", 'readonly': False,
+        'writeapi': True, 'uploadsenabled': True,
+        'thumblimits': {str(i): w for i, w in enumerate(
+            (120, 150, 180, 200, 220, 250, 300, 400))},
+        'imagelimits': {'0': {'width': 320, 'height': 240}},
+        'favicon': "//commons.wikimedia.org/static/favicon/commons.ico",
+        'linktrail': "/^([a-z]+)(.*)$/sD", 'linkprefixcharset': "",
+        'categorycollation': "uppercase", 'magiclinks': { },
+    },
+    'namespaces': { str(n): dict(id=n, case="first-letter", name=name,
+                                 canonical=name, content=n in (0, 6),
+                                 subpages=n % 2 == 1 or n == 2)
+                    for n, name in (
+                        (-2, "Media"), (-1, "Special"), (0, ""),
+                        (1, "Talk"), (2, "User"), (3, "User talk"),
+                        (4, "Commons"), (5, "Commons talk"), (6, "File"),
+                        (7, "File talk"), (8, "MediaWiki"),
+                        (9, "MediaWiki talk"), (10, "Template"),
+                        (11, "Template talk"), (12, "Help"),
+                        (13, "Help talk"), (14, "Category"),
+                        (15, "Category talk")) },
+    'namespacealiases': [{'id': 6, 'alias': "Image"},
+                         {'id': 7, 'alias': "Image talk"}],
+    'extensions': [{'type': "wikibase", 'name': "WikibaseMediaInfo"},
+                   {'type': "other", 'name': "UploadWizard"}],
+    'interwikimap': [ ],
+    'magicwords': [{'name': "redirect", 'aliases': ["#REDIRECT"],
+                    'case-sensitive': False}],
+    'restrictions': {'types': ["edit", "move", "upload"],
+                     'levels': ["", "autoconfirmed", "sysop"],
+                     'cascadinglevels': ["sysop"],
+                     'semiprotectedlevels': ["autoconfirmed"]},
+    'languages': [{'code': "en", 'bcp47': "en", 'name': "English"}],
+    'fileextensions': [{'ext': "jpg"}, {'ext': "jpeg"}, {'ext': "png"}],
+}
+
+# Descriptions of the API modules pywikibot might ask about, for
+# action=paraminfo.  Query modules: (group, prefix, generator?).
+query_modules = {
+    'revisions': ('prop', 'rv', True), 'info': ('prop', 'in', False),
+    'imageinfo': ('prop', 'ii', False), 'categories': ('prop', 'cl', True),
+    'templates': ('prop', 'tl', True), 'pageprops': ('prop', 'pp', False),
+    'coordinates': ('prop', 'co', False),
+    'categoryinfo': ('prop', 'ci', False),
+    'categorymembers': ('list', 'cm', True),
+    'allimages': ('list', 'ai', True), 'logevents': ('list', 'le', False),
+    'recentchanges': ('list', 'rc', True),
+    'usercontribs': ('list', 'uc', False),
+    'siteinfo': ('meta', 'si', False), 'userinfo': ('meta', 'ui', False),
+    'tokens': ('meta', '', False),
+}
+# Action modules, and whether they must be POSTed.
+action_modules = {
+    'query': False, 'paraminfo': False, 'login': True, 'edit': True,
+    'upload': True, 'wbgetentities': False, 'wbeditentity': True,
+    'parse': False, 'compare': False,
+}
+# The values of some multi-valued parameters.
+param_values = {
+    ('revisions', 'prop'): [
+        "ids", "flags", "timestamp", "user", "userid", "size", "slotsize",
+        "sha1", "slotsha1", "contentmodel", "comment", "parsedcomment",
+        "content", "tags", "roles"],
+    ('info', 'prop'): ["protection", "talkid", "watched", "url", "preload",
+                       "displaytitle"],
+    ('imageinfo', 'prop'): [
+        "timestamp", "user", "userid", "comment", "url", "size", "dimensions",
+        "sha1", "mime", "mediatype", "metadata", "bitdepth"],
+    ('tokens', 'type'): ["csrf", "login", "patrol", "rollback", "userrights",
+                         "watch"],
+    ('logevents', 'type'): ["upload", "delete", "move"],
+}
+
+def paraminfo_module(path):
+    def param(name, **kwargs):
+        info = dict(name=name, type="string")
+        info.update(kwargs)
+        return info
+    if path == 'main':
+        return dict(name="main", path="main", prefix="", parameters=[
+            param('action', type=sorted(action_modules),
+                  submodules={a: a for a in action_modules}),
+            param('format', type=["json"], submodules={'json': "json"}),
+            param('maxlag', type="integer"), param('assert'),
+            param('curtimestamp', type="boolean")])
+    if path == 'query':
+        parameters = [ ]
+        for group in ('prop', 'list', 'meta'):
+            names = sorted(n for n, m in query_modules.items()
+                           if m[0] == group)
+            parameters.append(param(
+                group, type=names, multi=True, limit=50, highlimit=500,
+                submodules={n: "query+" + n for n in names}))
+        names = sorted(n for n, m in query_modules.items() if m[2])
+        parameters.append(param(
+            'generator', type=names,
+            submodules={n: "query+" + n for n in names}))
+        for name in ('titles', 'pageids', 'revids'):
+            parameters.append(param(name, multi=True, limit=50,
+                                    highlimit=500))
+        parameters.append(param('indexpageids', type="boolean"))
+        parameters.append(param('continue'))
+        return dict(name="query", path="query", prefix="",
+                    parameters=parameters)
+    if path in action_modules:
+        info = dict(name=path, path=path, prefix="", parameters=[ ])
+        if action_modules[path]:
+            info['mustbeposted'] = True
+        return info
+    name = path.split('+', 1)[1] if path.startswith('query+') else path
+    if name not in query_modules:
+        return dict(name=name, path=path, missing=True)
+    group, prefix, generator = query_modules[name]
+    parameters = [
+        dict(name='prop', multi=True, limit=50, highlimit=500,
+             type=param_values.get((name, 'prop'), [ ])),
+        param('continue')]
+    if group in ('prop', 'list') and name not in ('info', 'pageprops'):
+        parameters.append(dict(name='limit', type="limit", min=1, max=500,
+                               highmax=5000, default=10))
+    if (name, 'type') in param_values:
+        parameters.append(dict(name='type', multi=True, limit=50,
+                               type=param_values[name, 'type']))
+    info = dict(name=name, path="query+" + name, group=group, prefix=prefix,
+                parameters=parameters)
+    if generator:
+        info['generator'] = True
+    return info
+
+class StandIn(object):
+    def __init__(self, pages=(), geograph_db=None, recorded=None):
+        self.pages = { }
+        for page in pages:
+            self.add_page(page)
+        self.geograph_db = geograph_db
+        self.geograph_local = threading.local()
+        self.recorded = { }
+        if recorded != None:
+            with open(recorded) as f:
+                self.recorded = json.load(f)
+        self.lock = threading.RLock()
+        # What's been asked for, and how long answering took.
+        self.counts = Counter()
+        self.times = defaultdict(float)
+        self.unhandled = Counter()
+        self.edits = 0
+        self.uploads = 0
+    def add_page(self, page):
+        self.pages[page.title] = page
+        self.pages[page.pageid] = page
+
+    # Dispatch.
+    def handle(self, method, url, params):
+        # Returns the kind of request, for the statistics, and
+        # (status, content type, body).
+        key = request_key(method, url, params)
+        if key in self.recorded:
+            entry = self.recorded[key]
+            return 'recorded', (entry['status'], entry['content_type'],
+                                entry['body'].encode('utf-8'))
+        parts = urlsplit(url)
+        if parts.path.endswith("/api.php"):
+            action = params.get('action', 'help')
+            kind = "api " + action
+            handler = getattr(self, 'api_' + action, None)
+            if handler == None:
+                self.note_unhandled(kind)
+                result = self.api_error('unknown_action',
+                                        "Unrecognized value for action")
+            else:
+                try:
+                    result = handler(params)
+                except Exception as e:
+                    # Most likely a request we don't model properly.
+                    self.note_unhandled("%s: %r" % (kind, e))
+                    result = self.api_error('internal_api_error', repr(e))
+            response = (200, "application/json",
+                        json.dumps(result).encode('utf-8'))
+        elif parts.netloc == "api.geograph.org.uk":
+            kind = "geograph oembed"
+            response = self.geograph_oembed(params)
+        elif parts.netloc.endswith("geograph.org.uk"):
+            kind = "geograph image"
+            response = self.geograph_image(parts.path, params)
+        elif parts.netloc == "upload.wikimedia.org":
+            kind = "commons image"
+            response = (200, "image/jpeg", fake_jpeg(parts.path))
+        elif parts.netloc == "global.mapit.mysociety.org":
+            kind = "mapit"
+            response = (200, "application/json", json.dumps(
+                {'2635167': {'name': "United Kingdom",
+                             'codes': {'iso3166_1': "GB"}}}).encode())
+        else:
+            kind = "unknown " + parts.netloc
+            self.note_unhandled(kind)
+            response = (404, "text/plain", b"not found")
+        return kind, response
+    def note(self, kind, elapsed):
+        with self.lock:
+            self.counts[kind] += 1
+            self.times[kind] += elapsed
+    def note_unhandled(self, kind):
+        with self.lock:
+            self.unhandled[kind] += 1
+
+    def api_error(self, code, info):
+        return {'error': {'code': code, 'info': info}}
+
+    # MediaWiki API.
+    def api_paraminfo(self, params):
+        return {'paraminfo': {'modules': [
+            paraminfo_module(path)
+            for path in params.get('modules', '').split('|') if path]}}
+    def api_query(self, params):
+        query = { }
+        result = {'batchcomplete': True, 'query': query}
+        meta = params.get('meta', '').split('|')
+        if 'siteinfo' in meta:
+            for prop in params.get('siprop', 'general').split('|'):
+                if prop in siteinfo:
+                    # A copy, since pywikibot changes what it's given.
+                    query[prop] = json.loads(json.dumps(siteinfo[prop]))
+        if 'userinfo' in meta:
+            query['userinfo'] = dict(
+                id=1, name=username, groups=["*", "user", "bot"],
+                rights=["read", "edit", "upload", "reupload",
+                        "upload_by_url", "bot", "writeapi", "apihighlimits",
+                        "editcontentmodel"],
+                editcount=1, messages=False, blockinfo=None)
+        if 'tokens' in meta:
+            # Not plain "+\\", which is the logged-out token.
+            query['tokens'] = { '%stoken' % (t,): "0123abcd+\\"
+                                for t in params.get('type', 'csrf')
+                                                 .split('|') }
+        pages = self.query_pages(params)
+        if pages != None:
+            query['pages'] = pages
+        return result
+    def query_pages(self, params):
+        if 'titles' in params:
+            wanted = params['titles'].split('|')
+        elif 'pageids' in params:
+            wanted = [int(i) for i in params['pageids'].split('|')]
+        elif 'revids' in params:
+            wanted = [ ]
+            for revid in params['revids'].split('|'):
+                for page in self.all_pages():
+                    if any(r['revid'] == int(revid) for r in page.revisions):
+                        wanted.append(page.pageid)
+        else:
+            return None
+        props = params.get('prop', '').split('|')
+        pages = [ ]
+        for name in wanted:
+            with self.lock:
+                page = self.pages.get(name)
+            if page == None:
+                pages.append(dict(ns=6, title=name, missing=True))
+                continue
+            with self.lock:
+                pages.append(self.page_info(page, props, params))
+        return pages
+    def all_pages(self):
+        with self.lock:
+            return [p for k, p in self.pages.items() if isinstance(k, int)]
+    def page_info(self, page, props, params):
+        info = dict(pageid=page.pageid, ns=6, title=page.title)
+        latest = page.latest
+        if 'info' in props:
+            info.update(contentmodel="wikitext", pagelanguage="en",
+                        touched=latest['timestamp'],
+                        lastrevid=latest['revid'], length=len(latest['text']))
+            if 'protection' in params.get('inprop', ''):
+                info['protection'] = [ ]
+                info['restrictiontypes'] = ["edit", "move", "upload"]
+        if 'revisions' in props:
+            rev = dict(revid=latest['revid'], parentid=0,
+                       user=latest['user'], timestamp=latest['timestamp'],
+                       comment=latest['comment'], minor=False,
+                       slots={'main': {'contentmodel': "wikitext",
+                                       'contentformat': "text/x-wiki"}})
+            # formatversion=1 (what pywikibot asks for) puts the text
+            # under '*'; formatversion=2 under 'content'.
+            textkey = ('content' if params.get('formatversion') == '2'
+                       else '*')
+            rev['slots']['main'][textkey] = latest['text']
+            if len(page.revisions) > 1:
+                rev['parentid'] = page.revisions[-2]['revid']
+            rev['sha1'] = hashlib.sha1(
+                latest['text'].encode('utf-8')).hexdigest()
+            rev['size'] = len(latest['text'])
+            info['revisions'] = [rev]
+        if 'imageinfo' in props:
+            limit = params.get('iilimit', '1')
+            limit = len(page.files) if limit == 'max' else int(limit)
+            infos = [ ]
+            for fi in reversed(page.files[-limit:] if limit else [ ]):
+                fi = dict(fi)
+                fi.pop('source')
+                if 'iiurlwidth' in params:
+                    fi.update(thumburl=fi['url'] + "/thumb.jpg",
+                              thumbwidth=int(params['iiurlwidth']),
+                              thumbheight=int(params.get('iiurlheight', 0)))
+                infos.append(fi)
+            info['imageinfo'] = infos
+            info['imagerepository'] = "local"
+        if 'categories' in props:
+            info['categories'] = [dict(
+                ns=14, title="Category:Images from Geograph Britain "
+                             "and Ireland")]
+        if 'templates' in props:
+            info['templates'] = [ ]
+        if 'pageprops' in props:
+            info['pageprops'] = { }
+        return info
+    def api_wbgetentities(self, params):
+        entities = { }
+        for mediaid in params['ids'].split('|'):
+            with self.lock:
+                page = self.pages.get(int(mediaid[1:]))
+                if page == None or not page.statements:
+                    entities[mediaid] = dict(id=mediaid, missing="")
+                else:
+                    entities[mediaid] = dict(
+                        id=mediaid, type="mediainfo",
+                        lastrevid=page.latest['revid'],
+                        statements=json.loads(json.dumps(page.statements)))
+        return {'entities': entities, 'success': 1}
+    def api_wbeditentity(self, params):
+        with self.lock:
+            page = self.pages[int(params['id'][1:])]
+            data = json.loads(params['data'])
+            for claim in data.get('claims', [ ]):
+                for prop, statements in page.statements.items():
+                    statements[:] = [s for s in statements
+                                     if s.get('id') != claim.get('id')]
+                if 'remove' not in claim:
+                    prop = claim['mainsnak']['property']
+                    page.statements.setdefault(prop, [ ]).append(claim)
+            rev = page.add_revision(page.latest['text'], username,
+                                    params.get('summary', ""))
+            self.edits += 1
+        return {'entity': {'id': params['id'], 'lastrevid': rev['revid']},
+                'success': 1}
+    def api_edit(self, params):
+        with self.lock:
+            page = self.pages.get(params.get('title'))
+            if page == None and 'pageid' in params:
+                page = self.pages.get(int(params['pageid']))
+            if page == None:
+                return self.api_error('missingtitle',
+                                      "The page you specified doesn't exist.")
+            if ('baserevid' in params and
+                int(params['baserevid']) != page.latest['revid']):
+                return self.api_error('editconflict', "Edit conflict.")
+            oldrevid = page.latest['revid']
+            rev = page.add_revision(params['text'], username,
+                                    params.get('summary', ""))
+            self.edits += 1
+        return {'edit': dict(result="Success", pageid=page.pageid,
+                             title=page.title, contentmodel="wikitext",
+                             oldrevid=oldrevid, newrevid=rev['revid'],
+                             newtimestamp=rev['timestamp'])}
+    def api_upload(self, params):
+        title = "File:" + params['filename'].replace("_", " ")
+        with self.lock:
+            page = self.pages.get(title)
+            if page == None:
+                return self.api_error('missingtitle', "No such file.")
+            url = params.get('url')
+            status, ctype, data = self.fetch_geograph(url)
+            m = re.search(r"size=(\d+|original)", url or "")
+            width, height = page.files[-1]['width'], page.files[-1]['height']
+            if m and m.group(1) == 'original':
+                row = self.geograph_row(int(re.search(r"id=(\d+)",
+                                                      url).group(1)))
+                if row != None:
+                    width, height = (row['original_width'],
+                                     row['original_height'])
+            page.add_file(data, width, height, username, url)
+            page.add_revision(page.latest['text'], username,
+                              params.get('comment', ""))
+            self.uploads += 1
+        return {'upload': dict(result="Success", filename=params['filename'],
+                               imageinfo=dict(page.files[-1], source=None))}
+
+    # Geograph.
+    def geograph_row(self, gridimage_id):
+        if self.geograph_db == None:
+            return None
+        try:
+            db = self.geograph_local.db
+        except AttributeError:
+            db = self.geograph_local.db = sqlite3.connect(self.geograph_db)
+            db.row_factory = sqlite3.Row
+        return db.execute("SELECT * FROM gridimage WHERE gridimage_id = ?",
+                          (gridimage_id,)).fetchone()
+    def geograph_oembed(self, params):
+        m = re.search(r"/photo/(\d+)", params.get('url', ''))
+        row = m and self.geograph_row(int(m.group(1)))
+        if not row:
+            return 404, "application/json", b'{"error":"not found"}'
+        gridimage_id = row['gridimage_id']
+        return 200, "application/json", json.dumps(dict(
+            version="1.0", type="photo", title=row['title'],
+            author_name=row['realname'], width=row['width'],
+            height=row['height'],
+            url="https://s0.geograph.org.uk/geophotos/%02d/%02d/%06d/"
+                "%d_%s.jpg" % (gridimage_id // 1000000,
+                               gridimage_id // 10000 % 100,
+                               gridimage_id // 100, gridimage_id,
+                               image_key(gridimage_id)))).encode()
+    def geograph_image(self, path, params):
+        if path == "/reuse.php":
+            return self.fetch_geograph(
+                "/reuse.php?" + urlencode(params))
+        return self.fetch_geograph(path)
+    def fetch_geograph(self, url):
+        # The same bytes for the same image and size however it's
+        # asked for, so that SHA-1 comparisons work.
+        m = re.search(r"[?&]id=(\d+)", url or "")
+        if m:
+            size = re.search(r"size=(\w+)", url).group(1)
+            return 200, "image/jpeg", geograph_jpeg(int(m.group(1)), size)
+        m = re.search(r"/(\d+)_[0-9a-f]{8}\.jpg$", url or "")
+        if m:
+            return 200, "image/jpeg", geograph_jpeg(int(m.group(1)), 'basic')
+        return 404, "text/plain", b"not found"
+
+def image_key(gridimage_id):
+    return hashlib.sha1(b"key%d" % (gridimage_id,)).hexdigest()[:8]
+
+jpeg_cache = { }
+
+def geograph_jpeg(gridimage_id, size):
+    key = (gridimage_id, str(size))
+    if key not in jpeg_cache:
+        jpeg_cache[key] = fake_jpeg(key)
+    return jpeg_cache[key]
+
+class StandInAdapter(requests.adapters.BaseAdapter):
+    # A requests transport that asks a StandIn instead of the network.
+    def __init__(self, standin):
+        super(StandInAdapter, self).__init__()
+        self.standin = standin
+    def send(self, request, **kwargs):
+        starttime = time.perf_counter()
+        kind, (status, ctype, body) = self.standin.handle(
+            request.method, request.url, request_params(request))
+        self.standin.note(kind, time.perf_counter() - starttime)
+        response = requests.Response()
+        response.status_code = status
+        response.reason = "OK" if status == 200 else "Error"
+        response.headers = CaseInsensitiveDict({
+            'Content-Type': ctype, 'Content-Length': str(len(body))})
+        response._content = body
+        response.encoding = 'utf-8' if 'json' in ctype else None
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+    def close(self):
+        pass
+
+def install(standin):
+    # Send all requests made through requests (including pywikibot's)
+    # to standin.  Returns a function that puts things back.
+    adapter = StandInAdapter(standin)
+    original = requests.Session.get_adapter
+    requests.Session.get_adapter = lambda self, url: adapter
+    def uninstall():
+        requests.Session.get_adapter = original
+    return uninstall
+
+def record(path):
+    # Let requests through to the real world, but save every response
+    # to path (when the returned function is called) so that a StandIn
+    # can serve them later.
+    recorded = { }
+    original = requests.Session.get_adapter
+    def get_adapter(self, url):
+        adapter = original(self, url)
+        class Recorder(requests.adapters.BaseAdapter):
+            def send(self, request, **kwargs):
+                response = adapter.send(request, **kwargs)
+                ctype = response.headers.get('Content-Type', '')
+                if 'json' in ctype or ctype.startswith('text/'):
+                    recorded[request_key(
+                        request.method, request.url,
+                        request_params(request))] = dict(
+                            status=response.status_code, content_type=ctype,
+                            body=response.text)
+                return response
+            def close(self):
+                adapter.close()
+        return Recorder()
+    requests.Session.get_adapter = get_adapter
+    def finish():
+        requests.Session.get_adapter = original
+        with open(path, 'w') as f:
+            json.dump(recorded, f, indent=1, sort_keys=True)
+    return finish
@@ -0,0 +1,47 @@
+from __future__ import division, print_function, unicode_literals
+
+import json
+import unittest
+
+import replay
+
+class StandInTests(unittest.TestCase):
+    def setUp(self):
+        self.page = replay.FilePage(123, "File:Test.jpg",
+                                    "{{Geograph|5|Someone}}")
+        self.standin = replay.StandIn([self.page])
+    def api(self, **params):
+        kind, (status, ctype, body) = self.standin.handle(
+            "POST", "https://commons.wikimedia.org/w/api.php", params)
+        self.assertEqual(status, 200)
+        return json.loads(body)
+    def test_request_key(self):
+        self.assertEqual(
+            replay.request_key("GET", "https://x.org/w/api.php?b=1",
+                               dict(b="1", a="2", token="abc")),
+            replay.request_key("GET", "https://x.org/w/api.php",
+                               dict(a="2", b="1", maxlag="5")))
+    def test_revisions(self):
+        r = self.api(action="query", prop="revisions", titles="File:Test.jpg",
+                     rvslots="*")
+        slot = r['query']['pages'][0]['revisions'][0]['slots']['main']
+        self.assertEqual(slot['*'], "{{Geograph|5|Someone}}")
+        r = self.api(action="query", prop="info", titles="File:Nothing.jpg")
+        self.assertTrue(r['query']['pages'][0]['missing'])
+    def test_edit(self):
+        baserevid = self.page.latest['revid']
+        r = self.api(action="edit", title="File:Test.jpg", text="New",
+                     baserevid=str(baserevid))
+        self.assertEqual(r['edit']['result'], "Success")
+        self.assertEqual(self.page.latest['text'], "New")
+        r = self.api(action="edit", title="File:Test.jpg", text="Newer",
+                     baserevid=str(baserevid))
+        self.assertEqual(r['error']['code'], "editconflict")
+        self.assertEqual(self.standin.edits, 1)
+    def test_unhandled(self):
+        r = self.api(action="move", title="File:Test.jpg")
+        self.assertEqual(r['error']['code'], "unknown_action")
+        self.assertEqual(self.standin.unhandled, {'api move': 1})
+
+if __name__ == '__main__':
+    unittest.main()
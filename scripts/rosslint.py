@@ -7,16 +7,12 @@ import pywikibot
 import mwparserfromhell
 import requests
 import re
-import sqlite3
 from urllib.parse import urlencode
 
-from gubutil import connect_geograph_db, tlgetone
+from gubutil import geograph_db, tlgetone
 
 site = pywikibot.Site()
 
-geodb = connect_geograph_db()
-geodb.row_factory = sqlite3.Row
-
 client = requests.Session()
 client.headers['User-Agent'] = "rosslint (bjh21@bjh21.me.uk)"
 
@@ -59,7 +55,7 @@ def find_undersized():
         gridimage_id = int(str(geograph_template.get(1).value))
         commons_author = str(geograph_template.get(2).value)
         if commons_author != "Ross Watson": continue
-        c = geodb.cursor()
+        c = geograph_db().cursor()
         c.execute("""
             SELECT * FROM gridimage_size
                WHERE gridimage_id = ?
@@ -80,4 +76,5 @@ def find_undersized():
                item.title(asLink=True, textlink=True)))
 
 
-find_undersized()
+if __name__ == '__main__':
+    find_undersized()
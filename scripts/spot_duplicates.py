@@ -8,10 +8,19 @@ import pywikibot.data.api as api
 import pywikibot.pagegenerators
 import sys
 import toolforge
+from gubutil import open_category_index
 
-def find_duplicates():
-    outfile = StringIO()
-    site = pywikibot.Site()
+def duplicate_ids():
+    # Rows of (gridimage_id, comma-separated page IDs) for Geograph IDs
+    # used by more than one file.  The local category index is much
+    # cheaper to ask than the Toolforge replica, so use it if we can.
+    index = open_category_index()
+    if index != None:
+        return index.execute(
+            """  SELECT gridimage_id, GROUP_CONCAT(pageid) AS page_ids
+                   FROM pages
+               GROUP BY gridimage_id
+                 HAVING COUNT(*) > 1""")
     conn = toolforge.connect('commonswiki')
     cur = conn.cursor()
     cur.execute(
@@ -23,11 +32,13 @@ def find_duplicates():
                 AND cl_sortkey_prefix <> ''
            GROUP BY cl_sortkey_prefix
              HAVING COUNT(*) > 1""")
-    for row in cur:
+    return cur
+
+def find_duplicates():
+    outfile = StringIO()
+    site = pywikibot.Site()
+    for row in duplicate_ids():
         gridimage_id = row[0]
-        print(
-            "* [https://www.geograph.org.uk/photo/%d %d]" %
-            (gridimage_id, gridimage_id), file=outfile)
         pageids = row[1].split(",")
         mwrequest = site.simple_request(
             action="query", pageids="|".join(pageids),
@@ -37,8 +48,16 @@ def find_duplicates():
             iiprop="size", imlimit="max",
             plnamespace="6", pllimit="max")
         data = mwrequest.submit()
-        items = sorted(data['query']['pages'].values(),
+        # The category index can be a little out of date, so some of
+        # these may have left the category (or Commons) since.
+        items = sorted((i for i in data['query']['pages'].values()
+                        if i.get("categories")),
                        key=lambda i: i["categories"][0]["sortkey"])
+        if len(items) < 2:
+            continue
+        print(
+            "* [https://www.geograph.org.uk/photo/%d %d]" %
+            (gridimage_id, gridimage_id), file=outfile)
         crosslinks = {(s['title'], d['title'])
                       for s in items
                       for d in
@@ -79,4 +98,5 @@ def main(*args):
 
     find_duplicates()
 
-main()
+if __name__ == '__main__':
+    main()
@@ -4,41 +4,33 @@ from io import StringIO
 import pywikibot
 import pywikibot.bot as bot
 import pywikibot.comms.http as http
-import pywikibot.data.api as api
 import pywikibot.pagegenerators
-import sqlite3
 from urllib.parse import urlsplit
-from gubutil import connect_geograph_db
-
-geodb = connect_geograph_db()
-geodb.row_factory = sqlite3.Row
+from gubutil import geograph_db, GeographCategoryMembers
 
 def find_rejected():
     outfile = StringIO()
     site = pywikibot.Site()
-    c = geodb.cursor()
+    c = geograph_db().cursor()
     c.execute("""
         SELECT MAX(gridimage_id) FROM gridimage_base
             ORDER BY gridimage_id desc limit 1""")
     row = c.fetchone()
     maxid = row[0]
     titles_by_id = { }
-    for item in api.ListGenerator("categorymembers", site=site,
-            cmtitle="Category:Images from Geograph Britain and Ireland",
-            cmprop="title|sortkeyprefix", cmtype="file"):
+    for gridimage_id, title in GeographCategoryMembers(site):
         try:
-            gridimage_id = int(item['sortkeyprefix'])
-            titles_by_id[gridimage_id] = item['title']
+            titles_by_id[gridimage_id] = title
             if gridimage_id > maxid: continue
             print(gridimage_id, end="\r")
-            c = geodb.cursor()
+            c = geograph_db().cursor()
             c.execute("""
                 SELECT gridimage_id FROM gridimage_base
                 WHERE gridimage_id = ?
                 """, (gridimage_id,))
             if c.fetchone() == None:
                 print("* [https://www.geograph.org.uk/photo/%d %d]: [[:%s]]" %
-                      (gridimage_id, gridimage_id, item['title']),
+                      (gridimage_id, gridimage_id, title),
                       file=outfile, flush=True)
                 r = http.fetch(
                     'https://www.geograph.org.uk/photo/%d' % (gridimage_id,),
@@ -69,4 +61,5 @@ def main(*args):
 
     find_rejected()
 
-main()
+if __name__ == '__main__':
+    main()
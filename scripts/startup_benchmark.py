@@ -0,0 +1,110 @@
+#! /usr/bin/python3
+
+# Measure how long the entry points take to get going.  Each run is a
+# fresh interpreter, so nothing is already imported.  With no
+# arguments, this times importing every entry point.  Given an entry
+# point and its arguments, it also runs it up to the first page
+# reaching the bot (or, for the show-* tools, to the end), for
+# example:
+#
+#   python3 scripts/startup_benchmark.py update_metadata -page:File:X.jpg
+#   python3 scripts/startup_benchmark.py show-location 12345
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+entry_points = (
+    "update_metadata", "upgrade_size", "category_index",
+    "precompute_locations", "spot_duplicates", "spot_rejected",
+    "fix_locations", "fix_other_fields", "source_locations", "rosslint",
+    "show-location", "show-creditline")
+
+# Run in the child.  Times are from just before the import.
+child = r"""
+import importlib.machinery, importlib.util, json, os, sys, time
+t0 = time.perf_counter()
+name, args = sys.argv[1], sys.argv[2:]
+path = os.path.join(os.environ['scriptdir'], name)
+if os.path.exists(path + '.py'):
+    module = importlib.import_module(name)
+else:
+    # The show-* tools have no .py suffix.
+    loader = importlib.machinery.SourceFileLoader(name.replace('-', '_'),
+                                                  path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+result = dict(imported=time.perf_counter() - t0, first_page=None)
+if args:
+    import pywikibot.bot
+    class FirstPage(Exception):
+        pass
+    def init_page(self, item):
+        raise FirstPage
+    pywikibot.bot.BaseBot.init_page = init_page
+    sys.argv = [path] + args
+    try:
+        if name.startswith('show-'):
+            module.main() # These read sys.argv.
+        else:
+            module.main(*args)
+    except FirstPage:
+        pass
+    result['first_page'] = time.perf_counter() - t0
+print(json.dumps(result))
+"""
+
+def run_once(name, args):
+    env = dict(os.environ, scriptdir=scriptdir)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [scriptdir] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    starttime = time.monotonic()
+    p = subprocess.run([sys.executable, "-c", child, name] + args, env=env,
+                       stdout=subprocess.PIPE, universal_newlines=True)
+    total = time.monotonic() - starttime
+    if p.returncode != 0:
+        return None
+    result = json.loads(p.stdout.strip().splitlines()[-1])
+    result['process'] = total
+    return result
+
+def describe(times):
+    times = [t for t in times if t != None]
+    if not times:
+        return "-"
+    return "%.3f s (min %.3f)" % (statistics.median(times), min(times))
+
+def main():
+    parser = argparse.ArgumentParser(description=
+        "Time importing the bot scripts, and getting to the first page.")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the raw timings to FILE")
+    parser.add_argument('entry', nargs='?', choices=entry_points)
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    names = [args.entry] if args.entry else entry_points
+    report = { }
+    for name in names:
+        runs = [run_once(name, args.args) for i in range(args.runs)]
+        if None in runs:
+            print("%s: failed" % (name,))
+            continue
+        report[name] = runs
+        print("%s: import %s, first page %s, whole process %s" %
+              (name, describe([r['imported'] for r in runs]),
+               describe([r['first_page'] for r in runs]),
+               describe([r['process'] for r in runs])))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+
+if __name__ == '__main__':
+    main()
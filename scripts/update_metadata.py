@@ -14,20 +14,22 @@ import json
 from math import copysign
 import mwparserfromhell
 import re
-import sqlite3
 from uuid import uuid4
 
 from creditline import creditline_from_row, can_add_creditline, add_creditline
-from location import (location_from_row, object_location_from_row,
-                      camera_statement_from_row, object_statement_from_row,
-                      az_dist_between_locations, format_row,
+from location import (RowLocations, az_dist_between_locations, format_row,
                       format_direction, get_location, get_object_location,
                       set_location, set_object_location, location_params,
-                      MapItSettings, statement_matches_template)
+                      MapItSettings, statement_matches_template,
+                      loctls, objtls)
 
 from gubutil import (
-    connect_geograph_db, get_gridimage_id, TooManyTemplates, tlgetone,
-    NewGeographImages, GeoGeneratorFactory)
+    get_geograph_row, get_gridimage_id, TooManyTemplates, tlgetone, tlgetall,
+    NewGeographImages, GeoGeneratorFactory, PrefetchingGenerator, prefetched,
+    PageStates, SkipUnchangedPages, row_fingerprint, fetch_sdc_statements,
+    SDCPreloadingGenerator, EditScheduler)
+import phases
+from phases import phase, timed_generator
 
 # Ways that Geograph locations get in:
 # BotMultichill (example?)
@@ -35,9 +37,6 @@ from gubutil import (
 # File Upload Bot (Magnus Manske)
 # Geograph2commons
 
-geodb = connect_geograph_db()
-geodb.row_factory = sqlite3.Row
-
 class NotEligible(Exception):
     pass
 class MinorProblem(Exception):
@@ -55,12 +54,36 @@ class MajorProblem(Exception):
 class BadGeographDatabase(MajorProblem):
     pass
 
+# Change this whenever the bot's treatment of a page changes in a way
+# that pages it's already finished with should be looked at again.
+state_version = 1
+
+def fingerprint(gridimage_id):
+    return row_fingerprint(get_geograph_row(gridimage_id), state_version)
+
+def prefetch(page):
+    # Fetch what process_page() will want, for PrefetchingGenerator.
+    found = { }
+    with phase('parse'):
+        tree = mwparserfromhell.parse(page.text)
+    gridimage_id = get_gridimage_id(tree)
+    found['row', gridimage_id] = get_geograph_row(gridimage_id)
+    # SDC are only consulted when there are locations to update.
+    if tlgetall(tree, loctls + objtls):
+        found['sdc'] = prefetched(
+            page, 'sdc', lambda: fetch_sdc_statements(page))
+    return found
+
 class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
-    def __init__(self, generator, **kwargs):
+    def __init__(self, generator, states=None, scheduler=None, **kwargs):
         # call constructor of the super class
         super(UpdateMetadataBot, self).__init__(site=True, **kwargs)
         # assign the generator to the bot
         self.generator = generator
+        self.states = states
+        if scheduler == None:
+            scheduler = EditScheduler(self.site, workers=0)
+        self.scheduler = scheduler
     summary_formats = {
         # (camera_action, object_action)
         ('add', 'add'):
@@ -154,15 +177,39 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
             return "moved %.1f km %s" % (distance/1000, format_direction(azon))
         return "moved %.1f m %s" % (distance, format_direction(azon))
     def get_sdc_statements(self, page):
-        # SDC data aren't preloaded, so we make an API request every time.
-        # This could be better, wbgetentities can do batches of pages just
-        # like query.
-        mediaid = 'M%d' % (page.pageid,)
-        request = self.site.simple_request(action='wbgetentities',
-                                           ids=mediaid)
-        data = request.submit()
-        return data['entities'][mediaid].get('statements', {})
+        return prefetched(page, 'sdc', lambda: fetch_sdc_statements(page))
     def process_page(self, page):
+        plan = prefetched(page, 'plan', lambda: self.plan_edit(page))
+        if isinstance(plan, Exception):
+            raise plan
+        revid, write, record = plan
+        # Before we save, make sure pywikibot's view of the latest
+        # revision hasn't changed.  If it has, that invalidates
+        # our parse tree, and we need to start again.
+        if page.latest_revision_id != revid:
+            bot.log("page has changed (%d != %d): restarting edit" %
+                    (page.latest_revision_id, revid))
+            self.process_page(page)
+            return
+        if write == None:
+            # Nothing to save, so nothing to wait for.
+            record(revid)
+        else:
+            self.scheduler.submit(page.pageid, write)
+    def plan_ahead(self, page):
+        # For PrefetchingGenerator: plan page's edit in a worker
+        # thread, keeping any problem for process_page() to report.
+        try:
+            return {'plan': self.plan_edit(page)}
+        except (NotEligible, MinorProblem, MajorProblem,
+                TooManyTemplates) as e:
+            return {'plan': e}
+    def plan_edit(self, page):
+        # Work out what to do to page without changing anything, so
+        # that this can run for several pages at once.  Returns the
+        # revision ID the plan is based on, a function that makes the
+        # edit (None if there's nothing to change), and one that notes
+        # that the page is in sync as of a given revision.
         camera_action = None
         object_action = None
         sdc_camera_action = None
@@ -170,7 +217,8 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
         creditline_added = False
         sdc_edits = {}
         revid = page.latest_revision_id
-        tree = mwparserfromhell.parse(page.text)
+        with phase('parse'):
+            tree = mwparserfromhell.parse(page.text)
         try:
             gridimage_id = get_gridimage_id(tree)
         except ValueError as e:
@@ -179,16 +227,14 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
             raise BadTemplate(str(e))
             
         mapit = MapItSettings()
-        c = geodb.cursor()
-        c.execute("""
-            SELECT * FROM gridimage_base NATURAL JOIN gridimage_geo
-                          NATURAL JOIN gridimage_extra, sources
-               WHERE gridimage_id = ? AND sources.tablename = 'gridimage_geo'
-            """, (gridimage_id,))
-        row = c.fetchone()
+        row = prefetched(page, ('row', gridimage_id),
+                         lambda: get_geograph_row(gridimage_id))
         if row == None:
             raise NotInGeographDatabase("Geograph ID %d not in database" %
                                         (gridimage_id,))
+        # Everything below gets its locations from here, so each is
+        # only worked out once.
+        locations = RowLocations(row, mapit=mapit)
         try:
             old_location = get_location(tree)
         except IndexError:
@@ -204,8 +250,8 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
             minor = False
             mapit.allowed = True
             # No geocoding at all: add from Geograph
-            new_location = location_from_row(row, mapit=mapit)
-            new_object_location = object_location_from_row(row, mapit=mapit)
+            new_location = locations.location('camera')
+            new_object_location = locations.location('object')
             if new_location and new_location.get('prec').value != '1000':
                 set_location(tree, new_location)
                 camera_action = 'add'
@@ -221,8 +267,8 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
                 bot.log("Old geocoding is from Geograph")
                 # Existing geocoding all from Geograph, so updating
                 # from Geograph OK if needed.
-                new_location = location_from_row(row, mapit=mapit)
-                new_object_location = object_location_from_row(row, mapit=mapit)
+                new_location = locations.location('camera')
+                new_object_location = locations.location('object')
                 # Should we update locations?
                 should_set_cam = self.should_set_location(
                     old_location, new_location, "camera")
@@ -241,7 +287,7 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
                                 raise SDCMismatch("SDC/template mismatch: "
                                                   "%s vs %s" %
                                                   (s, old_location))
-                            s_new = camera_statement_from_row(row)
+                            s_new = locations.statement('camera')
                             if s_new == None:
                                 s_new = dict(id=s['id'], remove="")
                                 bot.log("Removing %s statement %s" %
@@ -262,7 +308,7 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
                                 raise SDCMismatch("SDC/template mismatch: "
                                                   "%s vs %s",
                                                   (s, old_object_location))
-                            s_new = object_statement_from_row(row)
+                            s_new = locations.statement('object')
                             if s_new == None:
                                 s_new = dict(id=s['id'], remove="")
                                 bot.log("Removing %s statement %s" %
@@ -279,14 +325,14 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
                     # geocoding statements.
                     if (sdc_object_action != None and
                         'P1259' not in statements and should_set_cam):
-                        s_new = camera_statement_from_row(row)
+                        s_new = locations.statement('camera')
                         if s_new != None:
                             sdc_camera_action = 'add'
                             sdc_edits.setdefault('claims', [])
                             sdc_edits['claims'].append(s_new)
                     if (sdc_camera_action != None and
                         'P9149' not in statements and should_set_obj):
-                        s_new = object_statement_from_row(row)
+                        s_new = locations.statement('object')
                         if s_new != None:
                             sdc_object_action = 'add'
                             sdc_edits.setdefault('claims', [])
@@ -294,7 +340,7 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
                 # Do it if necessary:
                 mapit.allowed = True
                 if should_set_cam:
-                    set_location(tree, location_from_row(row, mapit=mapit))
+                    set_location(tree, locations.location('camera'))
                     if old_location == None:
                         if new_location != None:
                             camera_action = 'add'
@@ -304,8 +350,7 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
                         else:
                             camera_action = 'update'
                 if should_set_obj:
-                    set_object_location(tree,
-                                    object_location_from_row(row, mapit=mapit))
+                    set_object_location(tree, locations.location('object'))
                     if old_object_location == None:
                         if new_object_location != None:
                             object_action = 'add'
@@ -322,7 +367,8 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
         else:
             bot.log("Cannot add credit line")
         newtext = str(tree)
-        if newtext != page.text:
+        changed = newtext != page.text
+        if changed:
             editgroup_summary = ""
             if sdc_edits:
                 # Generate an edit group ID.  See
@@ -355,31 +401,45 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
                     " [Powered by MapIt: https://global.mapit.mysociety.org]")
             summary += editgroup_summary
             bot.log("edit summary: %s" % (summary,))
-            # Before we save, make sure pywikibot's view of the latest
-            # revision hasn't changed.  If it has, that invalidates
-            # our parse tree, and we need to start again.
-            if page.latest_revision_id != revid:
-                bot.log("page has changed (%d != %d): restarting edit" %
-                        (page.latest_revision_id, revid))
-                self.process_page(page)
-                return
-            page.text = newtext
-            page.save(summary, minor=minor)
             if sdc_edits:
                 sdc_summary = (self.summary_formats[(sdc_camera_action,
                                                      sdc_object_action)]
                                .format(**format_params))
                 sdc_summary += editgroup_summary
                 bot.log("SDC edit summary: %s" % (sdc_summary,))
-                self.site.simple_request(
-                    action='wbeditentity', format='json',
-                    id='M%d' % (page.pageid,), data=json.dumps(sdc_edits),
-                    token=self.site.tokens['csrf'], summary=sdc_summary,
-                    bot=True, baserevid=revid).submit()
+        def record(latest_revid):
+            # The page is now in sync with Geograph, at least until
+            # one of them changes.
+            if self.states != None:
+                self.states.set(page.pageid, latest_revid, gridimage_id,
+                                row_fingerprint(row, state_version))
+        if not changed:
+            return revid, None, record
+        def write():
+            # Wikitext first, then structured data.
+            page.text = newtext
+            with phase('save'):
+                page.save(summary, minor=minor)
+            latest_revid = page.latest_revision_id
+            if sdc_edits:
+                with phase('sdc edit'):
+                    result = self.site.simple_request(
+                        action='wbeditentity', format='json',
+                        id='M%d' % (page.pageid,),
+                        data=json.dumps(sdc_edits),
+                        token=self.site.tokens['csrf'],
+                        summary=sdc_summary,
+                        bot=True, baserevid=revid).submit()
+                # The structured data edit makes a revision of its
+                # own, which pywikibot doesn't know about.
+                latest_revid = result['entity']['lastrevid']
+            record(latest_revid)
+        return revid, write, record
 
     def treat_page(self):
         try:
-            self.process_page(self.current_page)
+            with phase('treat page'):
+                self.process_page(self.current_page)
         except NotEligible as e:
             bot.log(str(e))
         except MinorProblem as e:
@@ -397,25 +457,72 @@ def main(*args):
     # This factory is responsible for processing command line arguments
     # that are also used by other scripts and that determine on which pages
     # to work on.
-    genFactory = GeoGeneratorFactory()
+    genFactory = GeoGeneratorFactory(task='update_metadata')
 
     extraparams = { }
+    prefetch_window = 0
+    planners = 0
+    writers = 4
+    min_gap = 1.0
+    reprocess = False
     # Parse command line arguments
     for arg in local_args:
 
         # Catch the pywikibot.pagegenerators options
         if genFactory.handle_arg(arg):
             continue  # nothing to do here
-    # The preloading option is responsible for downloading multiple
+        if arg.startswith('-prefetch:'):
+            prefetch_window = int(arg[len('-prefetch:'):])
+        if arg.startswith('-workers:'):
+            planners = int(arg[len('-workers:'):])
+        if arg.startswith('-writers:'):
+            writers = int(arg[len('-writers:'):])
+        if arg.startswith('-mingap:'):
+            min_gap = float(arg[len('-mingap:'):])
+        if arg == '-reprocess':
+            reprocess = True
+    gen = genFactory.getCombinedGenerator()
+    states = PageStates('update_metadata')
+    if gen and not reprocess:
+        # Before anything's loaded, drop pages that we've already
+        # brought into sync and that haven't changed since.
+        gen = SkipUnchangedPages(gen, states, fingerprint)
+    # The preloading generator is responsible for downloading multiple
     # pages from the wiki simultaneously.
-    gen = genFactory.getCombinedGenerator(preload=True)
     if gen:
+        gen = PreloadingGenerator(gen)
+        # Likewise their structured data, 50 pages to a request.
+        gen = SDCPreloadingGenerator(gen)
+    if gen and prefetch_window > 0:
+        gen = PrefetchingGenerator(gen, prefetch, window=prefetch_window)
+    if gen and planners > 0:
+        # Work out the edits for up to -workers pages ahead in a pool
+        # of threads, leaving the bot only to check and submit them.
+        # bot is set up below, before the first page is asked for.
+        # Log lines from different pages will be interleaved.
+        gen = PrefetchingGenerator(gen, lambda page: bot.plan_ahead(page),
+                                   window=planners)
+    if gen:
+        # Time spent waiting for the next page is mostly fetching
+        # wikitext and structured data.
+        gen = timed_generator(gen, 'next page')
+        # Saves happen in the background, -writers:0 to make them
+        # one at a time with the -pt throttle.
+        scheduler = EditScheduler(pywikibot.Site(), workers=writers,
+                                  min_gap=min_gap)
+        gen = genFactory.checkpointed(gen, scheduler)
         # pass generator and private options to the bot
-        bot = UpdateMetadataBot(gen, **options)
-        bot.run()  # guess what it does
+        bot = UpdateMetadataBot(gen, states=states, scheduler=scheduler,
+                                **options)
+        try:
+            bot.run()  # guess what it does
+        finally:
+            scheduler.close()
+            phases.report('update_metadata')
         return True
     else:
         pywikibot.bot.suggest_help(missing_generator=True)
         return False
 
-main()
+if __name__ == '__main__':
+    main()
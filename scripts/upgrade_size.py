@@ -11,9 +11,11 @@ import pywikibot.data.api as api
 from pywikibot.exceptions import APIError
 import pywikibot.pagegenerators
 from pywikibot.page import FilePage
+import queue
 import re
 import sqlite3
 import tempfile
+import threading
 from requests.exceptions import HTTPError
 from urllib.parse import urlencode
 import compare
@@ -21,32 +23,37 @@ from compare import compare_revisions
 import mwparserfromhell
 
 from gubutil import (
-    connect_geograph_db, canonicalise_name, tlgetone, TooManyTemplates,
-    GeoGeneratorFactory)
-
-geodb = connect_geograph_db()
-geodb.row_factory = sqlite3.Row
+    geograph_db, canonicalise_name, tlgetone, TooManyTemplates,
+    get_geograph_row, GeoGeneratorFactory, open_size_snapshot,
+    open_category_index, PrefetchingGenerator, prefetched, Checkpoints,
+    CheckpointingGenerator, fetch_sdc_statements, SDCPreloadingGenerator,
+    EditScheduler, geograph_file_page)
+import phases
+from phases import phase, timed_generator
 
 def get_geograph_info(gridimage_id):
     # Use the oEmbed API
-    r = http.fetch("https://api.geograph.org.uk/api/oembed",
-                   params={'url': 'https://www.geograph.org.uk/photo/%d' %
-                                  gridimage_id,
-                           'format': 'json'},
-                   headers={'Accept': 'application/json'})
+    with phase('oembed'):
+        r = http.fetch("https://api.geograph.org.uk/api/oembed",
+                       params={'url': 'https://www.geograph.org.uk/photo/%d' %
+                                      gridimage_id,
+                               'format': 'json'},
+                       headers={'Accept': 'application/json'})
     r.raise_for_status()
     j = r.json()
     return j
 
 def get_geograph_basic(gridimage_id, info):
-    r = http.fetch(info['url'], headers={'Accept': 'image/jpeg'})
+    with phase('download'):
+        r = http.fetch(info['url'], headers={'Accept': 'image/jpeg'})
     r.raise_for_status()
     return r.content
 
 def get_geograph_size(gridimage_id, info, size):
     url = get_geograph_size_url(gridimage_id, info, size)
     bot.log("Fetching from %s" % (url,))
-    r = http.fetch(url, headers={'Accept': 'image/jpeg'})
+    with phase('download'):
+        r = http.fetch(url, headers={'Accept': 'image/jpeg'})
     r.raise_for_status()
     return r.content
 
@@ -73,10 +80,19 @@ def get_geograph_size_url(gridimage_id, info, size):
 def get_geograph_full(gridimage_id, info):
     url = get_geograph_full_url(gridimage_id, info)
     bot.log("Fetching from %s" % (url,))
-    r = http.fetch(url, headers={'Accept': 'image/jpeg'})
+    with phase('download'):
+        r = http.fetch(url, headers={'Accept': 'image/jpeg'})
     r.raise_for_status()
     return r.content
 
+def get_file_info(page):
+    with phase('file info'):
+        return page.latest_file_info
+
+def get_file_history(page):
+    with phase('file info'):
+        return page.get_file_history()
+
 def aspect_ratios_match(w0, h0, w1, h1):
     # Treat aspect ratios as matching if they are within 1%
     # (allowing for possible rotation).
@@ -101,40 +117,99 @@ class MajorProblem(Exception):
 class BadGeographDatabase(MajorProblem):
     pass
 
+whynot_lock = threading.Lock()
+
 def whynot_setup():
     global whynot_db
-    whynot_db = sqlite3.connect('whynot.sqlite3')
+    # Shared by the threads of ShardedGeographsByNumber.
+    whynot_db = sqlite3.connect('whynot.sqlite3', check_same_thread=False)
     whynot_db.execute("""CREATE TABLE IF NOT EXISTS whynot
                          (last_checked DATE DEFAULT (date('now')),
                           gridimage_id INTEGER PRIMARY KEY,
                           whynot TEXT)""")
 
 def whynot(gridimage_id, message):
-    whynot_db.execute("""INSERT OR REPLACE INTO whynot (gridimage_id, whynot)
-                                         VALUES (?, ?)""",
-                      (gridimage_id, message))
-    whynot_db.commit()
+    with whynot_lock:
+        whynot_db.execute("""INSERT OR REPLACE INTO whynot
+                                    (gridimage_id, whynot) VALUES (?, ?)""",
+                          (gridimage_id, message))
+        whynot_db.commit()
+
+def check_sizes(row, fi):
+    # Raise NotEligible unless the Commons file (whose latest file info
+    # is fi) looks like a smaller version of what Geograph has.  This
+    # only needs what we already know, so it's done before asking
+    # Geograph anything.
+    gwidth, gheight, original_width, original_height, original_diff = [
+        row[x] for x in ('width', 'height', 'original_width',
+                         'original_height', 'original_diff')]
+    if fi.width >= original_width and fi.height >= original_height:
+        raise NotEligible("no higher-resolution version on Geograph")
+    if not aspect_ratios_match(fi.width, fi.height,
+                               original_width, original_height):
+        raise NotEligible("aspect ratios of images differ")
+    if (fi.width, fi.height) == (gwidth, gheight):
+        if original_diff == 'yes':
+            raise NotEligible("Geograph says pictures are different")
+    else:
+        if max(fi.width, fi.height) not in (800, 1024):
+            raise NotEligible("dimensions do not match any Geograph image")
+
+def check_history(file_history):
+    for ofi in file_history.values():
+        if ofi.user == "Geograph Update Bot":
+            raise NotEligible("file already uploaded by me")
+
+def prefetch(page):
+    # Fetch what UpgradeSizeBot.process_page() will want, for
+    # PrefetchingGenerator.  Anything odd about the page makes this
+    # fail, and process_page() can complain about it properly.
+    found = { }
+    with phase('parse'):
+        tree = mwparserfromhell.parse(page.text)
+    geograph_template = tlgetone(tree,
+                                 ['Geograph', 'Geograph from structured data'])
+    if geograph_template.name == "Geograph from structured data":
+        sdc = found['sdc'] = prefetched(
+            page, 'sdc', lambda: fetch_sdc_statements(page))
+        gridimage_id = int(sdc['P7482'][0]['qualifiers']['P7384'][0]
+                           ['datavalue']['value'])
+    else:
+        gridimage_id = int(str(geograph_template.get(1).value))
+    row = found['row', gridimage_id] = get_geograph_row(gridimage_id)
+    # Most images have no larger version, and then we're done.
+    if row == None or not row['original_width']:
+        return found
+    filepage = FilePage(page)
+    # Only bother Geograph about files that might be upgraded.
+    # process_page() will say why the others aren't.
+    try:
+        fi = found['file_info'] = get_file_info(filepage)
+        check_sizes(row, fi)
+        history = found['file_history'] = get_file_history(filepage)
+        check_history(history)
+    except NotEligible:
+        return found
+    found['geograph_info', gridimage_id] = get_geograph_info(gridimage_id)
+    return found
 
 class UpgradeSizeBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
-    def __init__(self, generator, **kwargs):
+    def __init__(self, generator, scheduler=None, **kwargs):
         # call constructor of the super class
         super(UpgradeSizeBot, self).__init__(site=True, **kwargs)
         # assign the generator to the bot
         self.generator = generator
+        if scheduler == None:
+            scheduler = EditScheduler(self.site, workers=0)
+        self.scheduler = scheduler
         self.geograph = pywikibot.Page(self.site, "Template:Geograph")
     def get_sdc_statements(self, page):
-        # SDC data aren't preloaded, so we make an API request every time.
-        # This could be better, wbgetentities can do batches of pages just
-        # like query.
-        mediaid = 'M%d' % (page.pageid,)
-        request = self.site.simple_request(action='wbgetentities',
-                                           ids=mediaid, props='claims')
-        data = request.submit()
-        return data['entities'][mediaid].get('statements', {})
+        return prefetched(page, 'sdc', lambda: fetch_sdc_statements(page))
     def process_page(self, page):
         if not page.botMayEdit():
             raise NotEligible("bot forbidden from editing this page")
-        tree = mwparserfromhell.parse(page.text)
+        with phase('parse'):
+            tree = mwparserfromhell.parse(page.text)
         try:
             geograph_template = tlgetone(tree,
                                          ['Geograph',
@@ -166,38 +241,22 @@ class UpgradeSizeBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
             except IndexError:
                 raise BadTemplate("broken {{Geograph}} template")
         bot.log("Geograph ID is %d" % (gridimage_id,))
-        c = geodb.cursor()
-        c.execute("""
-            SELECT * FROM gridimage_base NATURAL JOIN gridimage_size
-               WHERE gridimage_id = ?
-            """, (gridimage_id,))
-        row = c.fetchone()
-        if row == None:
+        row = prefetched(page, ('row', gridimage_id),
+                         lambda: get_geograph_row(gridimage_id))
+        if row == None or row['width'] == None:
             raise NotInGeographDatabase("Geograph ID %d not in database" %
                                         (gridimage_id,))
-        gwidth, gheight, original_width, original_height, original_diff = [
-            row[x] for x in ('width', 'height', 'original_width',
-                             'original_height', 'original_diff')]
-        if original_width == 0:
+        if row['original_width'] == 0:
             raise NotEligible("no high-res version available")
-        fi = page.latest_file_info
-        bot.log("%d × %d version available" % (original_width, original_height))
+        fi = prefetched(page, 'file_info', lambda: get_file_info(page))
+        bot.log("%d × %d version available" %
+                (row['original_width'], row['original_height']))
         bot.log("current Commons version is %d × %d" % (fi.width, fi.height))
-        if fi.width >= original_width and fi.height >= original_height:
-            raise NotEligible("no higher-resolution version on Geograph")
-        if not aspect_ratios_match(fi.width, fi.height,
-                                   original_width, original_height):
-            raise NotEligible("aspect ratios of images differ")
-        if (fi.width, fi.height) == (gwidth, gheight):
-            if original_diff == 'yes':
-                raise NotEligible("Geograph says pictures are different")
-        else:
-            if max(fi.width, fi.height) not in (800, 1024):
-                raise NotEligible("dimensions do not match any Geograph image")
-        for ofi in page.get_file_history().values():
-            if ofi.user == "Geograph Update Bot":
-                raise NotEligible("file already uploaded by me")
-        geograph_info = get_geograph_info(gridimage_id)
+        check_sizes(row, fi)
+        check_history(prefetched(page, 'file_history',
+                                 lambda: get_file_history(page)))
+        geograph_info = prefetched(page, ('geograph_info', gridimage_id),
+                                   lambda: get_geograph_info(gridimage_id))
         if (canonicalise_name(geograph_info['author_name']) !=
             canonicalise_name(commons_author)):
             raise NotEligible("author does not match Geograph (%s vs. %s)" %
@@ -221,13 +280,20 @@ class UpgradeSizeBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
                                    repr(geograph_info['title'])))
         geograph_image = get_geograph_size(gridimage_id, geograph_info,
                                            max(fi.width, fi.height))
-        if hashlib.sha1(geograph_image).hexdigest() != fi.sha1:
+        with phase('sha1'):
+            sha1 = hashlib.sha1(geograph_image).hexdigest()
+        if sha1 != fi.sha1:
             raise NotEligible("SHA-1 does not match Geograph %d px image." %
                               ( max(fi.width, fi.height),))
         bot.log("Image matches. Update possible.")
-        self.replace_file(page, get_geograph_full_url(gridimage_id,
-                                                      geograph_info))
-        compare_revisions(self.site, parameters=dict(titles=page.title()))
+        newurl = get_geograph_full_url(gridimage_id, geograph_info)
+        def write():
+            self.replace_file(page, newurl)
+            with phase('compare'):
+                compare_revisions(self.site,
+                                  parameters=dict(titles=page.title()))
+        self.scheduler.submit(page.pageid, lambda: self.reporting_problems(
+            getattr(page, 'gridimage_id', -1), write))
     def replace_file(self, page, newurl):
         bot.log("Uploading from %s" % (newurl,))
         def upload_problem(errors):
@@ -237,22 +303,31 @@ class UpgradeSizeBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
                     bot.warning(str(e))
                     carry_on = False
             return carry_on
-        success = page.upload(newurl, 
-                              comment="[[User:Geograph Update Bot/RES|"
-                              "Higher-resolution]] version from Geograph",
-                              ignore_warnings=upload_problem)
+        with phase('upload'):
+            success = page.upload(newurl,
+                                  comment="[[User:Geograph Update Bot/RES|"
+                                  "Higher-resolution]] version from Geograph",
+                                  ignore_warnings=upload_problem)
         if not success:
             raise UploadFailed("upload from %s to %s failed" % (newurl, page))
         return
 
     def treat_page(self):
+        gridimage_id = -1
+        if hasattr(self.current_page, 'gridimage_id'):
+            gridimage_id = self.current_page.gridimage_id
+        if self.current_page.namespace() != 6:
+            return # Not a file page
+        page = FilePage(self.current_page)
+        with phase('treat page'):
+            self.reporting_problems(gridimage_id,
+                                    lambda: self.process_page(page))
+
+    def reporting_problems(self, gridimage_id, fn):
+        # Call fn(), noting why it didn't work out, if it didn't.
+        # Also used for uploads, which happen later.
         try:
-            gridimage_id = -1
-            if hasattr(self.current_page, 'gridimage_id'):
-                gridimage_id = self.current_page.gridimage_id
-            if self.current_page.namespace() != 6:
-                return # Not a file page
-            self.process_page(FilePage(self.current_page))
+            fn()
         except NotEligible as e:
             whynot(gridimage_id, str(e))
             bot.log(str(e))
@@ -274,16 +349,9 @@ def InterestingGeographsByNumber(**kwargs):
     # Fetch starting ID from a special page.
     startpage = pywikibot.Page(site, 'User:Geograph Update Bot/last ID')
     start = int(startpage.text)
-    startsortkeyprefix=" %08d" % (start,)
     n = 0
-    g = api.QueryGenerator(parameters=dict(
-        generator="categorymembers",
-        gcmtitle="Category:Images from Geograph Britain and Ireland",
-        gcmtype="file", gcmstartsortkeyprefix=startsortkeyprefix,
-        prop="categories|imageinfo", cllimit="max", clprop="sortkey",
-        clcategories="Category:Images from Geograph Britain and Ireland",
-        iiprop="size"), **kwargs)
-    for page in InterestingGeographGenerator(site, g):
+    candidates = candidates_by_number(site, start)
+    for page in InterestingGeographGenerator(site, candidates):
         yield page
         n = n + 1;
         if (n % 50 == 0):
@@ -291,19 +359,94 @@ def InterestingGeographsByNumber(**kwargs):
             startpage.text = str(page.gridimage_id)
             startpage.save("Checkpoint: up to %d" % (page.gridimage_id,))
 
-def InterestingGeographsByDate(**kwargs):
-    site = kwargs['site']
-    g = api.QueryGenerator(parameters=dict(
+def candidates_by_number(site, first, last=None):
+    # Candidates with Geograph IDs from first to last (or the end), in
+    # order of ID.
+    index = open_category_index()
+    if index != None:
+        return index.execute("""
+            SELECT gridimage_id, pageid, title, width, height FROM pages
+             WHERE gridimage_id BETWEEN ? AND ? ORDER BY gridimage_id
+            """, (first, last if last != None else 1 << 62))
+    parameters = dict(
         generator="categorymembers",
         gcmtitle="Category:Images from Geograph Britain and Ireland",
-        gcmtype="file",
-        gcmsort="timestamp", gcmdir="older",
+        gcmtype="file", gcmstartsortkeyprefix=" %08d" % (first,),
         prop="categories|imageinfo", cllimit="max", clprop="sortkey",
         clcategories="Category:Images from Geograph Britain and Ireland",
-        iiprop="size"), **kwargs)
-    yield from InterestingGeographGenerator(site, g)
+        iiprop="size")
+    if last != None:
+        parameters['gcmendsortkeyprefix'] = " %08d" % (last + 1,)
+    return candidates_from_api(api.QueryGenerator(site=site,
+                                                  parameters=parameters))
+
+def ShardedGeographsByNumber(site, shards, checkpoints):
+    # Like InterestingGeographsByNumber, but the range of Geograph IDs
+    # is split into shards, each listed and screened by its own
+    # thread.  Each shard goes in order of ID and has its own
+    # checkpoint, and the results are merged as they come.  The split
+    # is kept in checkpoints so that it doesn't move as Geograph
+    # grows.  The last shard has no upper limit.
+    layout = checkpoints.get('bynumber layout')
+    if layout == None or int(layout.split()[0]) != shards:
+        max_id = geograph_db().execute(
+            "SELECT max(gridimage_id) FROM gridimage").fetchone()[0]
+        layout = "%d %d" % (shards, max_id // shards + 1)
+        checkpoints.set('bynumber layout', layout)
+    size = int(layout.split()[1])
+    merged = queue.Queue(maxsize=100)
+    finished = object()
+    def work(name, first, last):
+        try:
+            for page in InterestingGeographGenerator(
+                    site, candidates_by_number(site, first, last)):
+                page.checkpoint = (name, str(page.gridimage_id))
+                merged.put(page)
+            if last != None:
+                checkpoints.final[name] = str(last + 1)
+        except Exception as e:
+            pywikibot.error("%s failed: %r" % (name, e))
+        finally:
+            merged.put(finished)
+    for k in range(shards):
+        first = k * size
+        last = first + size - 1 if k < shards - 1 else None
+        name = "bynumber %d-%s" % (first, "" if last == None else last)
+        mark = checkpoints.get(name)
+        if mark != None: first = int(mark)
+        threading.Thread(target=work, args=(name, first, last),
+                         daemon=True).start()
+    running = shards
+    while running:
+        page = merged.get()
+        if page is finished:
+            running -= 1
+            continue
+        yield page
+
+def InterestingGeographsByDate(**kwargs):
+    site = kwargs['site']
+    index = open_category_index()
+    if index != None:
+        candidates = index.execute("""
+            SELECT gridimage_id, pageid, title, width, height FROM pages
+             ORDER BY added DESC
+            """)
+    else:
+        candidates = candidates_from_api(api.QueryGenerator(parameters=dict(
+            generator="categorymembers",
+            gcmtitle="Category:Images from Geograph Britain and Ireland",
+            gcmtype="file",
+            gcmsort="timestamp", gcmdir="older",
+            prop="categories|imageinfo", cllimit="max", clprop="sortkey",
+            clcategories="Category:Images from Geograph Britain and Ireland",
+            iiprop="size"), **kwargs))
+    yield from InterestingGeographGenerator(site, candidates)
 
-def InterestingGeographGenerator(site, g):
+def candidates_from_api(g):
+    # Turn the results of a categorymembers query into (gridimage_id,
+    # pageid, title, width, height) tuples like those from the category
+    # index.
     for item in g:
         try:
             # We only request a single category, and every file we get
@@ -314,13 +457,29 @@ def InterestingGeographGenerator(site, g):
             # Unparseable sort key.  Skip it.
             continue
         try:
-            c = geodb.cursor()
-            c.execute("""
-                SELECT width, height, original_width, original_height
-                    FROM gridimage_size
-                    WHERE gridimage_id = ?
-                """, (gridimage_id,))
-            row = c.fetchone()
+            ii = item['imageinfo'][0]
+            yield (gridimage_id, item['pageid'], item['title'],
+                   ii['width'], ii['height'])
+        except (KeyError, IndexError):
+            # Let InterestingGeographGenerator have a closer look.
+            yield gridimage_id, item['pageid'], item['title'], None, None
+
+def InterestingGeographGenerator(site, candidates):
+    # Screening uses the size snapshot if there is one, which saves a
+    # database query for every file.
+    sizes = open_size_snapshot()
+    for gridimage_id, pageid, title, width, height in candidates:
+        try:
+            if sizes != None:
+                row = sizes.get(gridimage_id)
+            else:
+                c = geograph_db().cursor()
+                c.execute("""
+                    SELECT width, height, original_width, original_height
+                        FROM gridimage_size
+                        WHERE gridimage_id = ?
+                    """, (gridimage_id,))
+                row = c.fetchone()
             if row == None:
                 raise NotInGeographDatabase("Geograph ID %d not in database" %
                                             (gridimage_id,))
@@ -330,8 +489,7 @@ def InterestingGeographGenerator(site, g):
             if not aspect_ratios_match(basic_width, basic_height,
                                        original_width, original_height):
                 raise NotEligible("aspect ratios of images differ")
-            ii = item['imageinfo'][0]
-            if ((ii['width'], ii['height']) in
+            if ((width, height) in
                 ((original_width, original_height),
                  (original_height, original_width))):
                 # We already have the full-resolution version or a
@@ -342,9 +500,7 @@ def InterestingGeographGenerator(site, g):
             continue
         except Exception:
             pass # Anything odd happens, yield the item for further inspection.
-        page = pywikibot.FilePage(site, item['title'])
-        page.gridimage_id = gridimage_id
-        yield page
+        yield geograph_file_page(site, title, pageid, gridimage_id)
         
 def main(*args):
     options = {}
@@ -354,9 +510,15 @@ def main(*args):
     # This factory is responsible for processing command line arguments
     # that are also used by other scripts and that determine on which pages
     # to work on.
-    genFactory = GeoGeneratorFactory()
+    genFactory = GeoGeneratorFactory(task='upgrade_size')
 
     gen = None
+    prefetch_window = 0
+    writers = 4
+    min_gap = 1.0
+    bynumber = False
+    shards = 0
+    checkpoints = None
     # Parse command line arguments
     for arg in local_args:
 
@@ -364,7 +526,20 @@ def main(*args):
         if genFactory.handle_arg(arg):
             continue  # nothing to do here
         if arg == '-bynumber':
-            gen = InterestingGeographsByNumber(site=pywikibot.Site())
+            bynumber = True
+        if arg.startswith('-shards:'):
+            shards = int(arg[len('-shards:'):])
+        if arg.startswith('-prefetch:'):
+            prefetch_window = int(arg[len('-prefetch:'):])
+        if arg.startswith('-writers:'):
+            writers = int(arg[len('-writers:'):])
+        if arg.startswith('-mingap:'):
+            min_gap = float(arg[len('-mingap:'):])
+    if bynumber and shards > 0:
+        checkpoints = Checkpoints('upgrade_size')
+        gen = ShardedGeographsByNumber(pywikibot.Site(), shards, checkpoints)
+    elif bynumber:
+        gen = InterestingGeographsByNumber(site=pywikibot.Site())
     # The preloading option is responsible for downloading multiple
     # pages from the wiki simultaneously.
     if not gen:
@@ -372,13 +547,33 @@ def main(*args):
     if not gen:
         gen = InterestingGeographsByDate(site=pywikibot.Site())
     if gen:
+        gen = SDCPreloadingGenerator(gen)
+    if gen and prefetch_window > 0:
+        gen = PrefetchingGenerator(gen, prefetch, window=prefetch_window)
+    if gen:
+        # Time spent waiting for the next page is mostly fetching
+        # wikitext and structured data.
+        gen = timed_generator(gen, 'next page')
+        # Uploads happen in the background, -writers:0 to make them
+        # one at a time with the -pt throttle.
+        scheduler = EditScheduler(pywikibot.Site(), workers=writers,
+                                  min_gap=min_gap)
+        if checkpoints != None:
+            gen = CheckpointingGenerator(gen, checkpoints, scheduler)
+        else:
+            gen = genFactory.checkpointed(gen, scheduler)
         whynot_setup()
         # pass generator and private options to the bot
-        bot = UpgradeSizeBot(gen, **options)
-        bot.run()  # guess what it does
+        bot = UpgradeSizeBot(gen, scheduler=scheduler, **options)
+        try:
+            bot.run()  # guess what it does
+        finally:
+            scheduler.close()
+            phases.report('upgrade_size')
         return True
     else:
         pywikibot.bot.suggest_help(missing_generator=True)
         return False
 
-main()
+if __name__ == '__main__':
+    main()